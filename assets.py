@@ -0,0 +1,81 @@
+import json
+import os
+import threading
+from io import BytesIO
+
+from csv_rows import is_missing
+from metrics import METRICS
+
+# Every expansion image folder has a manifest of the set images the scraper saved in it:
+#   <expansion path>/assets.json   {"icon": {"file": "icon.webp", "url": ..., "size": ...}, "symbol": {...}}
+# size is the byte count of the downloaded source. The loader resolves the icon and the symbol
+# through it, so images already on disk are never downloaded a second time
+MANIFEST_FILE = 'assets.json'
+ASSET_FILES = {'icon': 'icon.webp', 'symbol': 'symbol.webp'}
+
+def source_size(image_data):
+    if isinstance(image_data, BytesIO):
+        return image_data.getbuffer().nbytes
+    return len(image_data)
+
+class AssetManifest:
+    # The manifest of one expansion folder, read when created and written back by save()
+    def __init__(self, expansion_path):
+        self.expansion_path = expansion_path
+        self.path = os.path.join(expansion_path, MANIFEST_FILE)
+        self.lock = threading.Lock()
+        self.changed = False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                self.assets = json.load(file)
+        except (FileNotFoundError, ValueError): # never written, or left half written by a crash
+            self.assets = {}
+
+    def local_path(self, asset):
+        # Same form as the paths stored in CardExpansion
+        return self.expansion_path + '/' + ASSET_FILES[asset]
+
+    def record(self, asset, url, image_data=None):
+        # Without image_data (the image was not downloaded again) the size recorded before is kept
+        with self.lock:
+            previous = self.assets.get(asset, {})
+            size = source_size(image_data) if image_data is not None else previous.get('size') if previous.get('url') == url else None
+            entry = {'file': ASSET_FILES[asset], 'url': url, 'size': size}
+            if entry != previous:
+                self.assets[asset] = entry
+                self.changed = True
+
+    def is_on_disk(self, asset):
+        path = self.local_path(asset)
+        return os.path.exists(path) and os.path.getsize(path) > 0
+
+    def resolve(self, asset, url, fetch):
+        # Local path of the asset, or None if there is none. fetch(url) is only called when the file
+        # is not on disk, with the url the scraper recorded if any, and what it returns is saved
+        if self.is_on_disk(asset):
+            METRICS.count('assets_local')
+            if asset not in self.assets:
+                self.record(asset, url) # saved by a scraper that did not write manifests
+            return self.local_path(asset)
+        url = self.assets.get(asset, {}).get('url') or url
+        if is_missing(url):
+            return None
+        image_data = fetch(url)
+        if image_data is None:
+            return None
+        METRICS.count('assets_fetched')
+        from image_pipeline import save_image_to_file # PIL is only needed to save a downloaded asset
+        save_image_to_file(image_data, self.local_path(asset)) # renamed into place once written
+        self.record(asset, url, image_data)
+        return self.local_path(asset)
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            os.makedirs(self.expansion_path, exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(self.assets, file, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+            self.changed = False
@@ -0,0 +1,89 @@
+# Parse time per page of the scraper extractors on saved pages.
+# Pages are read from <fixtures>/sets/*.html and <fixtures>/cards/*.html, for example:
+#   python benchmarks/bench_parse.py --fixtures benchmarks/fixtures --repeat 5
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+
+import pokellector_scraper as scraper
+from page_parser import PARSER, make_soup, SET_PAGE
+
+SET_URL = 'https://www.pokellector.com/Benchmark-Expansion/'
+
+# Baseline: whole document with html.parser and a fresh regex search over the info block for every label,
+# as the scraper used to do
+def baseline_extract_info(soup, label):
+    for div in soup.select('.infoblurb div'):
+        strong_element = div.find('strong')
+        if strong_element and re.search(rf'\b{label}\b', strong_element.text, re.IGNORECASE):
+            return div.text.split(':', 1)[-1].strip()
+
+def baseline_card_page(content):
+    soup = BeautifulSoup(content, 'html.parser')
+    h1_element = soup.find('h1', class_='icon set')
+    for child in h1_element.find_all():
+        child.extract()
+    card_name = h1_element.get_text(strip=True)
+    jpn_name = baseline_extract_info(soup, 'JPN')
+    rarity = baseline_extract_info(soup, 'Rarity')
+    card_number = baseline_extract_info(soup, 'Card').split('/')[0]
+    return card_name, jpn_name, rarity, card_number, scraper.extract_alternative_versions(soup), scraper.get_image(soup)
+
+def set_page(soup):
+    return scraper.scrape_name_and_id(soup), scraper.scrape_card_number(soup), scraper.scrape_release_date(soup), scraper.scrape_card_urls(SET_URL, soup)
+
+def baseline_set_page(content):
+    return set_page(BeautifulSoup(content, 'html.parser'))
+
+def strained_set_page(content):
+    return set_page(make_soup(content, SET_PAGE))
+
+def time_per_page(parse, pages, repeat):
+    # Best of repeat runs, in milliseconds per page
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for content in pages:
+            parse(content)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000 / len(pages)
+
+def load_pages(fixtures, kind):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(fixtures, kind, '*.html'))):
+        with open(path, 'rb') as file:
+            pages.append(file.read())
+    return pages
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-page parse time of the baseline and the current page parser')
+    parser.add_argument('--fixtures', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    benchmarks = [
+        ('card', baseline_card_page, scraper.parse_card_page),
+        ('set', baseline_set_page, strained_set_page),
+    ]
+    print(f'tree builder: {PARSER}')
+    for kind, baseline, current in benchmarks:
+        pages = load_pages(args.fixtures, kind + 's')
+        if not pages:
+            print(f'{kind}: no fixture pages in {os.path.join(args.fixtures, kind + "s")}')
+            continue
+        if baseline(pages[0]) != current(pages[0]):
+            print(f'{kind}: the current parser returns different results than the baseline')
+        baseline_ms = time_per_page(baseline, pages, args.repeat)
+        current_ms = time_per_page(current, pages, args.repeat)
+        print(f'{kind}: {len(pages)} pages, baseline {baseline_ms:.2f} ms/page, current {current_ms:.2f} ms/page, {baseline_ms / current_ms:.1f}x')
+
+if __name__ == '__main__':
+    main()
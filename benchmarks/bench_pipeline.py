@@ -0,0 +1,201 @@
+# Offline throughput of the scraper and the loader, replayed from recorded fixtures:
+#   python benchmarks/bench_pipeline.py --fixtures benchmarks/fixtures --latency 0.05 --workers 8
+# The load stage runs against a recording cursor stub, or a throwaway Postgres with --dsn
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import FixtureStore
+from fixture_server import FixtureServer, route_http_client
+
+class RecordingCursor:
+    # Stands in for a psycopg2 cursor and counts the statements that would be sent
+    rowcount = -1 # unknown, as in the DB-API
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query, vars=None):
+        self.connection.database.round_trips += 1
+
+    def mogrify(self, query, vars=None):
+        return b'()'
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+class RecordingConnection:
+    dsn = 'benchmark-stub'
+    encoding = 'UTF8' # read by execute_values
+    closed = False
+
+    def __init__(self, database):
+        self.database = database
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+    def commit(self):
+        self.database.round_trips += 1
+
+    def rollback(self):
+        self.database.round_trips += 1
+
+class RecordingDatabase:
+    def __init__(self):
+        self.round_trips = 0
+
+    @contextmanager
+    def connection(self):
+        yield RecordingConnection(self)
+
+    def close(self):
+        pass
+
+def postgres_database(dsn, workers=0):
+    import psycopg2.extensions
+    from db_pool import Database
+
+    class CountingCursor(psycopg2.extensions.cursor):
+        def execute(self, query, vars=None):
+            database.round_trips += 1
+            return super().execute(query, vars)
+
+    database = Database({'dsn': dsn, 'cursor_factory': CountingCursor}, max_connections=max(4, workers))
+    database.round_trips = 0
+    return database
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux, encoder worker processes are counted separately
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+@contextmanager
+def stage(timings, name):
+    start = time.perf_counter()
+    yield
+    timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+def run(args):
+    import http_client
+    import pokellector_scraper as scraper
+    from metrics import METRICS
+    from rate_limiter import configure_rate_limit
+    from populate_db import populate_expansion_table, populate_expansion_table_parallel
+
+    store = FixtureStore(args.fixtures)
+    set_urls = store.urls('sets')
+    if not set_urls:
+        sys.exit(f'No recorded sets in {args.fixtures}, record some with benchmarks/fixtures.py')
+
+    server = FixtureServer(store, args.latency).start()
+    configure_rate_limit(args.requests_per_second, args.burst)
+    http_client.configure(pool_size=args.workers)
+    route_http_client(server)
+
+    work_dir = tempfile.mkdtemp(prefix='pkmn_bench_')
+    previous_dir = os.getcwd()
+    os.chdir(work_dir) # anything written relative to the working directory stays in work_dir
+    images_path = os.path.join(work_dir, 'expansion_images') # given to populate_db too, so it finds the set images
+    scraper.IMAGES_PATH = images_path
+    for folder in ('sets', 'cards'):
+        os.makedirs(os.path.join(work_dir, folder), exist_ok=True)
+
+    image_encoder = None
+    if args.image_workers:
+        from image_pipeline import ImageEncoder
+        image_encoder = ImageEncoder(args.image_workers)
+        scraper.set_image_encoder(image_encoder)
+
+    timings = {}
+    sets = cards = 0
+    try:
+        for set_url in set_urls:
+            with stage(timings, 'scrape_set'):
+                set_id, set_name, number_of_cards, number_of_secret_cards, formatted_release_date, card_urls, icon_image, symbol_image = scraper.scrape_set(set_url)
+            with stage(timings, 'scrape_card_info'):
+                set_cards = scraper.scrape_cards(card_urls, set_id, args.workers)
+            with stage(timings, 'save_data'):
+                info = [set_id, set_name, number_of_cards, number_of_secret_cards, formatted_release_date, icon_image, symbol_image, 'Benchmark', '']
+                scraper.save_data({set_id: {'info': info, 'cards': set_cards}}, work_dir, True)
+            sets += 1
+            cards += len(set_cards)
+        requests_served = server.requests
+
+        database = postgres_database(args.dsn, args.load_workers) if args.dsn else RecordingDatabase()
+        with stage(timings, 'populate_expansion_table'):
+            if args.load_workers:
+                populate_expansion_table_parallel(database, os.path.join(work_dir, 'sets'), os.path.join(work_dir, 'cards'), True, workers=args.load_workers,
+                                                  images_path=images_path)
+            else:
+                populate_expansion_table(database, os.path.join(work_dir, 'sets'), os.path.join(work_dir, 'cards'), True, bulk=args.bulk,
+                                         images_path=images_path)
+        database.close()
+        load_requests = server.requests - requests_served
+    finally:
+        os.chdir(previous_dir)
+        server.stop()
+        if image_encoder is not None:
+            scraper.set_image_encoder(None)
+            image_encoder.close()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    scrape_time = timings['scrape_set'] + timings['scrape_card_info']
+    own_rss, children_rss = peak_rss_mb()
+    return {
+        'sets': sets,
+        'cards': cards,
+        'latency_s': args.latency,
+        'workers': args.workers,
+        'timings_s': timings,
+        'requests': requests_served,
+        'load_requests': load_requests, # set images downloaded again by the loader
+        'bytes_fetched': server.bytes_sent,
+        'pages_per_s': requests_served / scrape_time if scrape_time else None,
+        'cards_per_s': cards / timings['scrape_card_info'] if timings['scrape_card_info'] else None,
+        'db_round_trips': database.round_trips,
+        'peak_rss_mb': own_rss,
+        'peak_rss_children_mb': children_rss,
+        'metrics': METRICS.summary(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Scraper and loader throughput on recorded fixtures')
+    parser.add_argument('--fixtures', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every response')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--requests-per-second', type=float, default=1000)
+    parser.add_argument('--burst', type=int, default=100)
+    parser.add_argument('--image-workers', type=int, default=0, help='encode images on a process pool, 0 encodes them inline')
+    parser.add_argument('--bulk', action='store_true', help='load cards with bulk_insert_cards')
+    parser.add_argument('--load-workers', type=int, default=0, help='load with populate_expansion_table_parallel on this many connections')
+    parser.add_argument('--dsn', help='throwaway Postgres to load into instead of the recording stub')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the scraped CSVs and images')
+    args = parser.parse_args()
+
+    results = run(args)
+    for key, value in results.items():
+        print(f'{key}: {value}')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# Startup time of the command line, and the heavy modules each command imports before doing anything.
+# Every command runs in a fresh interpreter, for example:
+#   python benchmarks/bench_startup.py --repeat 10
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('PIL', 'bs4', 'lxml', 'requests', 'psycopg2', 'pandas', 'openpyxl', 'pyarrow')
+PENDING_BUDGET = 0.15 # seconds, `pending` must not pay for the scraper or the database
+
+# Imports what `main.py <command>` imports before running it, then prints the heavy modules loaded
+PROBE = '''
+import sys
+sys.path.insert(0, {root!r})
+import main
+parser = main.build_parser()
+args = parser.parse_args({argv!r})
+{imports}
+print(' '.join(sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy!r}))))
+'''
+
+# Modules each command imports once it runs, without running it
+COMMAND_IMPORTS = {
+    'pending': 'from work_queue import WorkQueue',
+    'languages': 'from db_pool import Database; from populate_db import assign_expansion_languages',
+    'load': 'from db_pool import Database; from populate_db import populate_expansion_table',
+    'scrape': 'import pokellector_scraper, image_pipeline, db_pool, catalogue, populate_db',
+}
+
+def run_command(argv):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(ROOT, 'main.py'), *argv], check=True, capture_output=True)
+    return time.perf_counter() - start
+
+def loaded_modules(command, save_path):
+    probe = PROBE.format(root=ROOT, argv=['--save-path', save_path, command], imports=COMMAND_IMPORTS[command], heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', probe], check=True, capture_output=True, text=True)
+    return result.stdout.split()
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time of main.py commands')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    save_path = tempfile.mkdtemp(prefix='pkmn_startup_')
+    baseline = [run_command(['--help']) for _ in range(args.repeat)] # interpreter start and argparse only
+    pending = [run_command(['--save-path', save_path, 'pending']) for _ in range(args.repeat)]
+    results = {
+        'help_s': statistics.median(baseline),
+        'pending_s': statistics.median(pending),
+        'heavy_modules': {command: loaded_modules(command, save_path) for command in COMMAND_IMPORTS},
+    }
+    for key, value in results.items():
+        print(f'{key}: {value}')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+    failures = []
+    if results['heavy_modules']['pending']:
+        failures.append(f"pending imports {results['heavy_modules']['pending']}")
+    if results['pending_s'] > PENDING_BUDGET:
+        failures.append(f"pending took {results['pending_s']:.3f}s, over {PENDING_BUDGET}s")
+    if failures:
+        sys.exit('; '.join(failures))
+
+if __name__ == '__main__':
+    main()
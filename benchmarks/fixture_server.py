@@ -0,0 +1,99 @@
+# Local stand-in for pokellector: serves the responses recorded by fixtures.py with a configurable latency.
+# route_http_client() makes the shared http_client send every request to it, keeping the original
+# host in the Host header, so the scraper runs unchanged against real sockets
+import http.server
+import os
+import sys
+import threading
+import time
+from urllib.parse import urlparse, urlunparse
+
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class FixtureServer:
+    def __init__(self, store, latency=0.0, host='127.0.0.1', port=0):
+        self.store = store
+        self.latency = latency # seconds added before every response
+        self.requests = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.httpd = http.server.ThreadingHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def address(self):
+        host, port = self.httpd.server_address[:2]
+        return f'{host}:{port}'
+
+    def handler_class(self):
+        server = self
+
+        class FixtureHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep-alive, like the real site
+            disable_nagle_algorithm = True # headers and body are separate writes
+
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                url = f"https://{self.headers.get('Host')}{self.path}"
+                recorded = server.store.get(url)
+                if recorded is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body, content_type = recorded
+                etag = '"' + os.path.basename(server.store.index[url]['file']) + '"'
+                with server.lock:
+                    server.requests += 1
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                if content_type:
+                    self.send_header('Content-Type', content_type)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with server.lock:
+                    server.bytes_sent += len(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return FixtureHandler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class FixtureAdapter(HTTPAdapter):
+    # Rewrites every request to the fixture server, the original host goes in the Host header
+    def __init__(self, server_address, **kwargs):
+        self.server_address = server_address
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        parsed = urlparse(request.url)
+        request.headers['Host'] = parsed.netloc
+        request.url = urlunparse(('http', self.server_address, parsed.path, parsed.params, parsed.query, ''))
+        return super().send(request, **kwargs)
+
+def route_http_client(server):
+    import http_client
+    session = http_client.CLIENT.get_session()
+    adapter = FixtureAdapter(server.address, pool_connections=http_client.CLIENT.pool_size, pool_maxsize=http_client.CLIENT.pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
@@ -0,0 +1,98 @@
+# Records set pages, card pages and images from pokellector into a fixtures directory, so the benchmarks
+# can replay them offline through fixture_server:
+#   python benchmarks/fixtures.py --fixtures benchmarks/fixtures /Super-Electric-Breaker-Expansion/
+# Layout: index.json maps every recorded url to its body under responses/, set and card pages are
+# also copied to sets/ and cards/ for bench_parse.py
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+POKELLECTOR_URL = 'https://www.pokellector.com/'
+
+class FixtureStore:
+    def __init__(self, fixtures_dir):
+        self.fixtures_dir = fixtures_dir
+        self.index_path = os.path.join(fixtures_dir, 'index.json')
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as file:
+                self.index = json.load(file)
+
+    def add(self, url, body, content_type, kind=None):
+        digest = hashlib.sha256(body).hexdigest()
+        relative_path = os.path.join('responses', digest)
+        path = os.path.join(self.fixtures_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(body)
+        self.index[url] = {'file': relative_path, 'content_type': content_type, 'kind': kind}
+        if kind in ('sets', 'cards'):
+            page_dir = os.path.join(self.fixtures_dir, kind)
+            os.makedirs(page_dir, exist_ok=True)
+            with open(os.path.join(page_dir, digest[:16] + '.html'), 'wb') as file:
+                file.write(body)
+
+    def get(self, url):
+        # (body, content_type) of a recorded url, None if it was never recorded
+        entry = self.index.get(url)
+        if entry is None:
+            return None
+        with open(os.path.join(self.fixtures_dir, entry['file']), 'rb') as file:
+            return file.read(), entry['content_type']
+
+    def urls(self, kind):
+        return [url for url, entry in self.index.items() if entry.get('kind') == kind]
+
+    def save(self):
+        os.makedirs(self.fixtures_dir, exist_ok=True)
+        with open(self.index_path, 'w', encoding='utf-8') as file:
+            json.dump(self.index, file, indent=2, sort_keys=True)
+
+def record_url(store, url, kind=None):
+    import http_client
+    response = http_client.get(url)
+    if response.status_code != 200:
+        print(f'\tSkipping {url}: {response.status_code}')
+        return None
+    store.add(url, response.content, response.headers.get('Content-Type'), kind)
+    return response.content
+
+def record_set(store, set_url, max_cards=None):
+    from page_parser import make_soup, SET_PAGE
+    import pokellector_scraper as scraper
+
+    print('Recording set: ' + set_url)
+    content = record_url(store, set_url, 'sets')
+    if content is None:
+        return
+    soup = make_soup(content, SET_PAGE)
+    record_url(store, soup.find('h1', class_='icon symbol').find('img', src=True)['src'])
+    record_url(store, soup.find('meta', {'property': 'og:image'})['content'])
+
+    card_urls = scraper.scrape_card_urls(set_url, soup)
+    if max_cards is not None:
+        card_urls = card_urls[:max_cards]
+    for card_url in card_urls:
+        card_content = record_url(store, card_url, 'cards')
+        if card_content is not None:
+            record_url(store, scraper.parse_card_page(card_content)[-1])
+        print('\tRecorded ' + card_url)
+
+def main():
+    parser = argparse.ArgumentParser(description='Record pokellector pages and images as benchmark fixtures')
+    parser.add_argument('set_urls', nargs='+', help="expansion urls without the domain, IE, '/Base-Set-Expansion/'")
+    parser.add_argument('--fixtures', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+    parser.add_argument('--max-cards', type=int, default=None, help='cards recorded per set, all of them by default')
+    args = parser.parse_args()
+
+    store = FixtureStore(args.fixtures)
+    for set_url in args.set_urls:
+        record_set(store, POKELLECTOR_URL + set_url.lstrip('/'), args.max_cards)
+        store.save()
+
+if __name__ == '__main__':
+    main()
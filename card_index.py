@@ -0,0 +1,147 @@
+import csv
+import glob
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+
+from csv_rows import read_set_rows, read_card_rows
+from metrics import METRICS, timed
+
+# Local search over the names of every scraped card, English and Japanese, without a database.
+# Names are indexed by an FTS5 table with the trigram tokenizer, so any part of a name of at least
+# 3 characters matches in a few milliseconds. Shorter queries (a 2 character Japanese name) are
+# answered with a scan, and queries matching nothing fall back to the names sharing the most trigrams
+# with them, which finds misspelt names
+MIN_TRIGRAM_QUERY = 3
+DEFAULT_LIMIT = 20
+FUZZY_CANDIDATES = 200 # names sharing a trigram with a misspelt query that are compared with it
+
+CardMatch = namedtuple('CardMatch', ['expansion', 'expansion_name', 'number', 'card_name', 'jpn_name', 'rarity', 'is_jap', 'url'])
+
+def phrase(text):
+    # FTS5 string, so quotes and operators in a name are searched as they are
+    return '"' + text.replace('"', '""') + '"'
+
+def trigrams(text):
+    return sorted({text[index:index + 3] for index in range(len(text) - 2)})
+
+def similarity(query_trigrams, match):
+    # Jaccard similarity of the trigrams of the query and of the closest of the two names
+    best = 0
+    for name in (match.card_name, match.jpn_name):
+        if name:
+            name_trigrams = set(trigrams(name.lower()))
+            best = max(best, len(query_trigrams & name_trigrams) / len(query_trigrams | name_trigrams))
+    return best
+
+def like_pattern(text):
+    return '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+class CardIndex:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL') # searches don't wait for a set being written
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS cards (
+                id INTEGER PRIMARY KEY,
+                expansion TEXT NOT NULL,
+                expansion_name TEXT,
+                number TEXT,
+                card_name TEXT,
+                jpn_name TEXT,
+                rarity TEXT,
+                is_jap INTEGER NOT NULL,
+                url TEXT
+            );
+            CREATE INDEX IF NOT EXISTS cards_expansion ON cards (expansion);
+            CREATE VIRTUAL TABLE IF NOT EXISTS card_names USING fts5(
+                card_name, jpn_name, content='cards', content_rowid='id', tokenize='trigram'
+            );
+            CREATE TRIGGER IF NOT EXISTS cards_insert AFTER INSERT ON cards BEGIN
+                INSERT INTO card_names (rowid, card_name, jpn_name) VALUES (new.id, new.card_name, new.jpn_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS cards_delete AFTER DELETE ON cards BEGIN
+                INSERT INTO card_names (card_names, rowid, card_name, jpn_name) VALUES ('delete', old.id, old.card_name, old.jpn_name);
+            END;
+        ''')
+        self.conn.commit()
+
+    @timed('index_set')
+    def replace_set(self, set_info, cards, is_jap):
+        # The cards of a set replace the ones indexed before, as its CSV does
+        set_id, set_name = set_info[0], set_info[1]
+        rows = [(set_id, set_name, card.get('number'), card.get('card_name'), card.get('jpn_name'), card.get('rarity'), is_jap, card.get('url'))
+                for card in cards if card]
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM cards WHERE expansion = ?', (set_id,))
+            self.conn.executemany(
+                'INSERT INTO cards (expansion, expansion_name, number, card_name, jpn_name, rarity, is_jap, url) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows
+            )
+        METRICS.count('cards_indexed', len(rows))
+
+    def search(self, query, limit=DEFAULT_LIMIT, is_jap=None, fuzzy=True):
+        # Cards whose English or Japanese name contains query (case insensitive), best matches first.
+        # is_jap only keeps the Japanese (True) or world (False) sets
+        query = query.strip()
+        if not query:
+            return []
+        if len(query) < MIN_TRIGRAM_QUERY:
+            pattern = like_pattern(query)
+            return self.select("(cards.card_name LIKE ? ESCAPE '\\' OR cards.jpn_name LIKE ? ESCAPE '\\')", (pattern, pattern), is_jap, limit)
+        matches = self.select('card_names MATCH ?', (phrase(query),), is_jap, limit)
+        if not matches and fuzzy:
+            # Names sharing trigrams with the query, the ones sharing the largest part of theirs first
+            query_trigrams = set(trigrams(query.lower()))
+            candidates = self.select('card_names MATCH ?', (' OR '.join(phrase(trigram) for trigram in sorted(query_trigrams)),), is_jap, FUZZY_CANDIDATES)
+            matches = sorted(candidates, key=lambda match: -similarity(query_trigrams, match))[:limit]
+        return matches
+
+    def select(self, condition, parameters, is_jap, limit):
+        fts = 'MATCH' in condition
+        sql = (
+            'SELECT cards.expansion, cards.expansion_name, cards.number, cards.card_name, cards.jpn_name, cards.rarity, cards.is_jap, cards.url '
+            + ('FROM card_names JOIN cards ON cards.id = card_names.rowid ' if fts else 'FROM cards ')
+            + f'WHERE {condition}'
+        )
+        if is_jap is not None:
+            sql += ' AND cards.is_jap = ?'
+            parameters = (*parameters, is_jap)
+        sql += (' ORDER BY card_names.rank' if fts else ' ORDER BY cards.card_name') + ' LIMIT ?'
+        with self.lock:
+            rows = self.conn.execute(sql, (*parameters, limit)).fetchall()
+        return [CardMatch(*row[:6], bool(row[6]), row[7]) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def is_jap_set_csv(path):
+    # write_set_csv leaves the italian_name column out of the Japanese sets
+    with open(path, 'r', newline='', encoding='utf-8') as file:
+        return 'italian_name' not in next(csv.reader(file), [])
+
+def index_saved_sets(index, save_path):
+    # Indexes every set CSV in save_path, loaded ('processed') or not, e.g. for catalogues scraped
+    # before the index existed. Returns the number of sets indexed
+    from pokellector_scraper import cards_csv_path
+    indexed = 0
+    for set_path in sorted(glob.glob(os.path.join(save_path, 'sets', '*.csv')) + glob.glob(os.path.join(save_path, 'sets', 'processed sets', '*.csv'))):
+        for row in read_set_rows(set_path, encoding='utf-8'):
+            cards_path = cards_csv_path(save_path, row.id)
+            if not os.path.exists(cards_path):
+                cards_path = os.path.join(os.path.dirname(cards_path), 'processed cards', os.path.basename(cards_path))
+            if not os.path.exists(cards_path):
+                continue
+            cards = [card_row._asdict() for card_row in read_card_rows(cards_path, encoding='utf-8')]
+            index.replace_set([row.id, row.name], cards, is_jap_set_csv(set_path))
+            indexed += 1
+    return indexed
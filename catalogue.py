@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from urllib.parse import urljoin
+
+from pokellector_scraper import scrape_set, extract_catalogue
+from checkpoint import CrawlJournal, journal_path
+from pipeline import stream_set, QUEUE_SIZE, BATCH_SIZE, IMAGES_PATH
+from incremental import update_set
+from metrics import METRICS
+
+# Pages listing every set, English and Japanese
+CATALOGUE_URLS = {
+    False: 'https://www.pokellector.com/sets',
+    True: 'https://jp.pokellector.com/sets',
+}
+SET_WORKERS = 4 # sets crawled at the same time, each with its own card workers
+IDLE_WAIT = 1 # seconds a worker waits for a retry while other sets are still running
+
+logger = logging.getLogger(__name__)
+
+def crawl_set(set_url, generation, is_jap, save_path, italian_name='', update=False, db=None, max_workers=8, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE,
+              images_path=IMAGES_PATH):
+    # Scrapes one set and streams its cards to the CSVs and (optionally) the database, returns its id
+    scraped = scrape_set(set_url)
+    if not scraped:
+        raise RuntimeError(f'Failed to retrieve {set_url}')
+    set_id, set_name, number_of_cards, number_of_secret_cards, formatted_release_date, card_urls, icon_image, symbol_image = scraped
+    set_info = [set_id, set_name, number_of_cards, number_of_secret_cards, formatted_release_date, icon_image, symbol_image, generation, italian_name]
+    # Cards already recorded in the journal by an interrupted run are not scraped again
+    journal = CrawlJournal(journal_path(save_path, set_id))
+
+    # Cards are written to the CSV and inserted in the database while the crawl is still running.
+    # Sets scraped before can be updated instead, fetching only the cards they don't have yet
+    load_set = update_set if update else stream_set
+    load_set(set_info, card_urls, save_path, is_jap, max_workers, journal, db, queue_size=queue_size, batch_size=batch_size, images_path=images_path)
+    journal.discard()
+    return set_id
+
+def discover_sets(queue, is_jap, catalogue_url=None):
+    # Adds every listed set to the queue, sets queued by a previous run keep their status
+    catalogue_url = catalogue_url or CATALOGUE_URLS[is_jap]
+    added = 0
+    for set_url, generation in extract_catalogue(catalogue_url):
+        set_url = urljoin(catalogue_url, set_url)
+        if queue.add(set_url, {'url': set_url, 'generation': generation, 'is_jap': is_jap}):
+            added += 1
+    logger.info('Discovered sets', extra={'catalogue': catalogue_url, 'new_sets': added})
+    return added
+
+class CatalogueCrawler:
+    # Runs the sets of a work_queue.WorkQueue on set_workers threads. The rate limiter and the HTTP
+    # connections are process wide, so more workers only help until the request budget is used up
+    def __init__(self, queue, save_path, db=None, set_workers=SET_WORKERS, card_workers=8, update=False, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE,
+                 images_path=IMAGES_PATH):
+        self.queue = queue
+        self.save_path = save_path
+        self.db = db
+        self.set_workers = set_workers
+        self.card_workers = card_workers
+        self.update = update
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.images_path = images_path
+        self.running = 0 # sets being crawled, a failure may put one back in the queue
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def run(self):
+        self.queue.recover()
+        workers = [threading.Thread(target=self.work, name=f'set-worker-{index}', daemon=True) for index in range(self.set_workers)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(IDLE_WAIT)
+        except KeyboardInterrupt:
+            # Sets being crawled stay running in the queue and are recovered by the next run
+            self.stopped.set()
+            raise
+        counts = self.queue.counts()
+        logger.info('Catalogue crawl finished', extra=counts)
+        return counts
+
+    def work(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                item = self.queue.claim()
+                if item is not None:
+                    self.running += 1
+                elif self.running == 0:
+                    return # nothing pending and nothing that could fail and come back
+            if item is None:
+                time.sleep(IDLE_WAIT)
+                continue
+            try:
+                self.crawl(*item)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+    def crawl(self, key, payload):
+        try:
+            set_id = crawl_set(payload['url'], payload.get('generation'), payload['is_jap'], self.save_path, payload.get('italian_name', ''),
+                               self.update, self.db, self.card_workers, self.queue_size, self.batch_size, self.images_path)
+        except Exception as e:
+            retry = self.queue.fail(key, e)
+            METRICS.count('sets_failed')
+            logger.exception('Set failed', extra={'url': key, 'retry': retry})
+        else:
+            self.queue.complete(key)
+            METRICS.count('sets_crawled')
+            logger.info('Set crawled', extra={'url': key, 'set_id': set_id})
@@ -0,0 +1,54 @@
+import json
+import os
+import threading
+
+def journal_path(save_path, set_id):
+    return os.path.join(save_path, 'checkpoints', f'{set_id}.jsonl')
+
+class CrawlJournal:
+    # Append-only JSONL file with one line per scraped card, so a crawl interrupted halfway
+    # can restart from the cards that are still missing
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = self.load()
+
+    def load(self):
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        end = 0 # offset after the last complete line
+        with open(self.path, 'rb') as file:
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break # truncated, the process died while writing it
+                end += len(line)
+                try:
+                    record = json.loads(line)
+                    done[record['url']] = record['card']
+                except (ValueError, KeyError, TypeError):
+                    continue # unreadable line, the records after it are still good
+        # The truncated line is cut off, so the next record starts on a line of its own
+        if end < os.path.getsize(self.path):
+            os.truncate(self.path, end)
+        return done
+
+    def get(self, url):
+        return self.done.get(url)
+
+    def record(self, url, card_info):
+        line = json.dumps({'url': url, 'card': card_info}, ensure_ascii=False)
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(line + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            self.done[url] = card_info
+
+    def discard(self):
+        # Called once the set has been saved, the journal is not needed anymore
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.done = {}
@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import threading
+from datetime import date
+
+from csv_rows import SetRow
+from metrics import METRICS, timed
+
+# Optional sink writing the catalogue as two datasets partitioned by set, next to the CSVs:
+#   <path>/sets/set_id=<id>/part-0.<ext>    one row per set
+#   <path>/cards/set_id=<id>/part-0.<ext>   one row per card, alternate versions as a list column
+# 'parquet' is compact, 'arrow' (uncompressed IPC files) can be memory-mapped without decoding.
+# pyarrow is only imported when a sink or a loader is used
+FORMATS = {'parquet': 'parquet', 'arrow': 'ipc'}
+EXTENSIONS = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+logger = logging.getLogger(__name__)
+
+def set_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('id', pa.string()),
+        ('name', pa.string()),
+        ('cards', pa.int32()),
+        ('secret_cards', pa.int32()),
+        ('release_date', pa.date32()),
+        ('icon_image', pa.string()),
+        ('symbol_image', pa.string()),
+        ('generation', pa.string()),
+        ('italian_name', pa.string()),
+        ('is_jap', pa.bool_()),
+    ])
+
+def card_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('card_name', pa.string()),
+        ('jpn_name', pa.string()),
+        ('rarity', pa.string()),
+        ('number', pa.string()),
+        ('alternate_versions', pa.list_(pa.string())),
+        ('image', pa.string()),
+        ('image_paths', pa.map_(pa.string(), pa.string())),
+        ('url', pa.string()),
+    ])
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def to_date(value):
+    if isinstance(value, date) or not value:
+        return value or None
+    return date.fromisoformat(value)
+
+def alternate_versions(value):
+    # Cards scraped in this run have a list, cards read back from a CSV its string representation
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.strip('[]')
+        return [version.strip().strip("'") for version in value.split(',')] if value else []
+    return list(value)
+
+def image_paths(value):
+    # size -> path pairs, cards read back from a CSV have the JSON written by card_row
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = json.loads(value)
+    return list(value.items())
+
+class ColumnarSink:
+    # Collects the cards of each set as they are scraped (sets may be scraped concurrently) and
+    # writes the set and its cards once the set is complete. Writing a set again replaces it
+    def __init__(self, path, format='parquet'):
+        if format not in FORMATS:
+            raise ValueError(f'Unknown columnar format {format}, expected one of {sorted(FORMATS)}')
+        self.path = path
+        self.format = format
+        self.cards = {}
+        self.lock = threading.Lock()
+
+    def add_card(self, set_id, card):
+        with self.lock:
+            self.cards.setdefault(set_id, []).append(card)
+
+    def partition_path(self, dataset, set_id):
+        return os.path.join(self.path, dataset, f'set_id={set_id}', f'part-0.{EXTENSIONS[self.format]}')
+
+    @timed('columnar_write_set')
+    def write_set(self, set_info, is_jap):
+        import pyarrow as pa
+        set_id = set_info[0]
+        with self.lock:
+            cards = self.cards.pop(set_id, [])
+        set_id, name, number_of_cards, number_of_secret_cards, release_date, icon_image, symbol_image, generation, italian_name = set_info
+        set_table = pa.Table.from_pylist([{
+            'id': set_id, 'name': name, 'cards': to_int(number_of_cards), 'secret_cards': to_int(number_of_secret_cards),
+            'release_date': to_date(release_date), 'icon_image': icon_image, 'symbol_image': symbol_image,
+            'generation': generation or None, 'italian_name': italian_name or None, 'is_jap': is_jap,
+        }], schema=set_schema())
+        card_table = pa.Table.from_pylist([{
+            'card_name': card['card_name'], 'jpn_name': card['jpn_name'], 'rarity': card['rarity'], 'number': card['number'],
+            'alternate_versions': alternate_versions(card['alternate versions']), 'image': card['image'],
+            'image_paths': image_paths(card.get('image_paths')), 'url': card.get('url'),
+        } for card in cards], schema=card_schema())
+        self.write_table(set_table, self.partition_path('sets', set_id))
+        self.write_table(card_table, self.partition_path('cards', set_id))
+        METRICS.count('columnar_cards', len(cards))
+
+    def write_table(self, table, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        if self.format == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(table, tmp_path)
+        else:
+            import pyarrow as pa
+            with pa.OSFile(tmp_path, 'wb') as file, pa.ipc.new_file(file, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+
+# Loader
+
+def open_dataset(path, dataset, format='parquet'):
+    # Files are memory-mapped, with 'arrow' the columns are used in place without being copied
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    from pyarrow import fs
+    # set_id is always a string, otherwise it is inferred as an integer when every set id is numeric
+    partitioning = ds.partitioning(pa.schema([('set_id', pa.string())]), flavor='hive')
+    return ds.dataset(
+        os.path.join(path, dataset), format=FORMATS[format], partitioning=partitioning,
+        filesystem=fs.LocalFileSystem(use_mmap=True),
+    )
+
+def load_sets(path, format='parquet'):
+    return open_dataset(path, 'sets', format).to_table()
+
+def load_cards(path, format='parquet', set_ids=None):
+    # Only the partitions of set_ids are read if given
+    import pyarrow.dataset as ds
+    dataset = open_dataset(path, 'cards', format)
+    if set_ids is None:
+        return dataset.to_table()
+    return dataset.to_table(filter=ds.field('set_id').isin(list(set_ids)))
+
+def set_rows(sets_table):
+    # SetRows in release order, as populate_expansion_table loads them
+    rows = sorted(sets_table.to_pylist(), key=lambda row: (row['release_date'] or date.min, row['name'] or ''))
+    return [SetRow(
+        id=row['id'], name=row['name'], cards=row['cards'], secret_cards=row['secret_cards'],
+        release_date=row['release_date'].isoformat() if row['release_date'] else None,
+        icon_image=row['icon_image'], symbol_image=row['symbol_image'], generation=row['generation'], italian_name=row['italian_name'],
+    ) for row in rows]
+
+def card_tuples(cards_table):
+    # (number, card_name, rarity, illustrator, alt_versions, image_sizes) tuples for bulk_insert_cards,
+    # numbered like populate_cardtype numbers the cards without one
+    columns = cards_table.select(['number', 'card_name', 'rarity', 'alternate_versions', 'image_paths']).to_pydict()
+    cards = []
+    unnumbered_index = 1
+    for number, card_name, rarity, versions, paths in zip(columns['number'], columns['card_name'], columns['rarity'], columns['alternate_versions'], columns['image_paths']):
+        if not number: # missing or empty, as the CSV reader and DatabaseSink treat it
+            number = 'unnumbered_'+str(unnumbered_index)
+            unnumbered_index += 1
+        cards.append((number, card_name, rarity, None, versions, [size for size, path in paths] if paths else None))
+    return cards
+
+@timed('populate_from_columnar')
+def populate_from_columnar(db, path, is_jap, format='parquet', sets_dict=None, upsert=False, images_path=None):
+    # Same load as populate_expansion_table from the columnar datasets: no CSV parsing, and the
+    # alternate versions are already lists. images_path defaults to populate_db.IMAGES_PATH
+    import pyarrow.compute as pc
+    from populate_db import insert_expansion, bulk_insert_cards, get_super_expansion, IMAGES_PATH
+    from pokellector_scraper import set_csv_path
+    from lookup_cache import commit
+
+    images_path = images_path or IMAGES_PATH
+    sets_table = load_sets(path, format)
+    sets_table = sets_table.filter(pc.equal(sets_table['is_jap'], is_jap))
+    rows = set_rows(sets_table)
+    cards_table = load_cards(path, format, [row.id for row in rows])
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        for row in rows:
+            super_expansion = get_super_expansion(os.path.basename(set_csv_path('', row.id))) # as if loaded from its CSV
+            expansion_path = insert_expansion(cursor, row, is_jap, sets_dict, super_expansion, path, upsert=upsert, images_path=images_path)
+            if expansion_path is None:
+                continue
+            set_cards = cards_table.filter(pc.equal(cards_table['set_id'], row.id))
+            bulk_insert_cards(cursor, row.id, card_tuples(set_cards), upsert, images_path)
+            commit(conn)
+        cursor.close()
+    logger.info('Expansion table populated from columnar datasets', extra={'path': path, 'sets': len(rows)})
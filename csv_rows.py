@@ -0,0 +1,57 @@
+import csv
+from collections import namedtuple
+
+CSV_ENCODING = 'latin1' # the encoding the loader has always read the scraped CSVs with
+
+# CSV column -> row field, columns missing from a file are read as None
+SET_COLUMNS = {
+    'id': 'id',
+    'name': 'name',
+    'cards #': 'cards',
+    'secret cards #': 'secret_cards',
+    'release date': 'release_date',
+    'icon_image': 'icon_image',
+    'symbol_image': 'symbol_image',
+    'generation': 'generation',
+    'italian_name': 'italian_name',
+    'Italiano': 'italiano',
+}
+CARD_COLUMNS = {
+    'card_name': 'card_name',
+    'jpn_name': 'jpn_name',
+    'rarity': 'rarity',
+    'number': 'number',
+    'alternate versions': 'alternate_versions',
+    'image': 'image',
+    'image_paths': 'image_paths',
+    'illustrator': 'illustrator',
+    'url': 'url',
+}
+
+SetRow = namedtuple('SetRow', SET_COLUMNS.values(), defaults=(None,) * len(SET_COLUMNS))
+CardRow = namedtuple('CardRow', CARD_COLUMNS.values(), defaults=(None,) * len(CARD_COLUMNS))
+
+def is_missing(value):
+    # Empty cells are read as None, NaN still shows up in values coming from spreadsheets
+    return value is None or value != value
+
+def read_rows(path, row_type, columns, encoding=CSV_ENCODING):
+    with open(path, 'r', newline='', encoding=encoding) as file:
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header is None:
+            return []
+        indexes = [(columns[column], index) for index, column in enumerate(header) if column in columns]
+        rows = []
+        for values in reader:
+            if not values:
+                continue
+            fields = {field: values[index] or None for field, index in indexes if index < len(values)}
+            rows.append(row_type(**fields))
+        return rows
+
+def read_set_rows(path, encoding=CSV_ENCODING):
+    return read_rows(path, SetRow, SET_COLUMNS, encoding)
+
+def read_card_rows(path, encoding=CSV_ENCODING):
+    return read_rows(path, CardRow, CARD_COLUMNS, encoding)
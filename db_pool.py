@@ -0,0 +1,64 @@
+import time
+from contextlib import contextmanager
+
+from psycopg2.extensions import connection, cursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from lookup_cache import rollback
+from metrics import METRICS
+
+MIN_CONNECTIONS = 1
+MAX_CONNECTIONS = 4
+
+class InstrumentedCursor(cursor):
+    # Every execute is one round trip, execute_values goes through it once per page
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            METRICS.observe('db_execute', time.perf_counter() - start)
+            METRICS.count('db_round_trips')
+
+class InstrumentedConnection(connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = InstrumentedCursor
+
+    def commit(self):
+        METRICS.count('db_round_trips')
+        METRICS.count('db_commits')
+        return super().commit()
+
+    def rollback(self):
+        METRICS.count('db_round_trips')
+        return super().rollback()
+
+class Database:
+    # Created once per run and passed to the populate functions, which check connections out
+    # of the pool instead of opening (and often leaking) their own
+    def __init__(self, db_params, min_connections=MIN_CONNECTIONS, max_connections=MAX_CONNECTIONS):
+        self.db_params = db_params
+        self.pool = ThreadedConnectionPool(min_connections, max_connections, **{'connection_factory': InstrumentedConnection, **db_params})
+
+    @contextmanager
+    def connection(self):
+        conn = self.pool.getconn()
+        try:
+            yield conn
+        except BaseException:
+            if not conn.closed:
+                rollback(conn)
+            raise
+        finally:
+            # The pool rolls back whatever transaction was left open before reusing the connection
+            self.pool.putconn(conn)
+
+    def close(self):
+        self.pool.closeall()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,138 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+DEFAULT_TTL = 24 * 3600 # seconds before a cached response is revalidated with the server
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3 # bytes, least recently used bodies are evicted above this
+
+class CacheEntry:
+    __slots__ = ('url', 'digest', 'etag', 'last_modified', 'content_type', 'validated_at', 'size')
+
+    def __init__(self, url, digest, etag, last_modified, content_type, validated_at, size):
+        self.url = url
+        self.digest = digest
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_type = content_type
+        self.validated_at = validated_at
+        self.size = size
+
+class ResponseCache:
+    # Bodies are stored once per sha256 under objects/, the SQLite index maps every url to its body
+    # together with the validators needed for conditional GETs
+    def __init__(self, cache_dir, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.ttl = ttl
+        self.max_size = max_size
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite'), check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                url TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                content_type TEXT,
+                validated_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                size INTEGER NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)')
+        self.conn.commit()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def lookup(self, url):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT url, digest, etag, last_modified, content_type, validated_at, size FROM entries WHERE url = ?', (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        entry = CacheEntry(*row)
+        if not os.path.exists(self.object_path(entry.digest)):
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry.validated_at < self.ttl
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def load(self, entry, revalidated=False):
+        # Builds a response equivalent to the one originally stored
+        with open(self.object_path(entry.digest), 'rb') as file:
+            body = file.read()
+        now = time.time()
+        with self.lock:
+            if revalidated:
+                self.conn.execute('UPDATE entries SET validated_at = ?, last_access = ? WHERE url = ?', (now, now, entry.url))
+            else:
+                self.conn.execute('UPDATE entries SET last_access = ? WHERE url = ?', (now, entry.url))
+            self.conn.commit()
+        return build_response(entry.url, body, entry.content_type)
+
+    def store(self, url, response):
+        body = response.content
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as file:
+                file.write(body)
+            os.replace(tmp_path, path)
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO entries (url, digest, etag, last_modified, content_type, validated_at, last_access, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (url, digest, response.headers.get('ETag'), response.headers.get('Last-Modified'), response.headers.get('Content-Type'), now, now, len(body))
+            )
+            self.conn.commit()
+            self._evict()
+
+    def _evict(self):
+        # Drop least recently used urls until the distinct bodies fit in max_size
+        total_size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM entries)').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        for url, digest in self.conn.execute('SELECT url, digest FROM entries ORDER BY last_access').fetchall():
+            self.conn.execute('DELETE FROM entries WHERE url = ?', (url,))
+            still_used = self.conn.execute('SELECT size FROM entries WHERE digest = ? LIMIT 1', (digest,)).fetchone()
+            if still_used is None:
+                path = self.object_path(digest)
+                if os.path.exists(path):
+                    total_size -= os.path.getsize(path)
+                    os.remove(path)
+            if total_size <= self.max_size:
+                break
+        self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def build_response(url, body, content_type):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response._content = body
+    response.headers = CaseInsensitiveDict({'Content-Type': content_type} if content_type else {})
+    response.encoding = get_encoding_from_headers(response.headers)
+    return response
@@ -0,0 +1,155 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rate_limiter import RATE_LIMITER
+from metrics import METRICS
+
+CONNECT_TIMEOUT = 10 # seconds
+READ_TIMEOUT = 30 # seconds
+MAX_RETRIES = 4
+BACKOFF_FACTOR = 1 # seconds, doubled at every retry
+MAX_BACKOFF = 60 # seconds, also caps the Retry-After sent by the server
+POOL_SIZE = 16 # keep-alive connections kept open per host
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+logger = logging.getLogger(__name__)
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_date.tzinfo is None:
+        retry_date = retry_date.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_date - datetime.now(timezone.utc)).total_seconds())
+
+class HttpClient:
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, pool_size=POOL_SIZE, cache=None):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.cache = cache # optional http_cache.ResponseCache
+        self.session = None
+        self.lock = threading.Lock()
+
+    def configure(self, timeout=None, max_retries=None, backoff_factor=None, pool_size=None, cache=None):
+        with self.lock:
+            if cache is not None:
+                self.cache = cache
+            if timeout is not None:
+                self.timeout = timeout
+            if max_retries is not None:
+                self.max_retries = max_retries
+            if backoff_factor is not None:
+                self.backoff_factor = backoff_factor
+            if pool_size is not None and pool_size != self.pool_size:
+                self.pool_size = pool_size
+                self._close_session()
+
+    def get_session(self):
+        # One session for the whole process, its adapters keep the connections alive between requests
+        with self.lock:
+            if self.session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session = session
+            return self.session
+
+    def backoff(self, attempt):
+        return min(MAX_BACKOFF, self.backoff_factor * 2 ** attempt)
+
+    def get(self, url, **kwargs):
+        cache = self.cache
+        if cache is None:
+            return self.fetch(url, **kwargs)
+
+        entry = cache.lookup(url)
+        if entry is not None and cache.is_fresh(entry):
+            METRICS.count('http_cache_hits')
+            return cache.load(entry)
+        if entry is not None:
+            kwargs['headers'] = {**cache.conditional_headers(entry), **kwargs.get('headers', {})}
+
+        response = self.fetch(url, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            METRICS.count('http_not_modified')
+            return cache.load(entry, revalidated=True)
+        if response.status_code == 200:
+            cache.store(url, response)
+        return response
+
+    def fetch(self, url, **kwargs):
+        session = self.get_session()
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            RATE_LIMITER.acquire(url)
+            METRICS.observe('rate_limit_wait', time.perf_counter() - start)
+            start = time.perf_counter()
+            try:
+                response = session.get(url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                METRICS.count('http_errors')
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                logger.warning('Request failed, retrying', extra={'url': url, 'error': e.__class__.__name__, 'delay_s': delay})
+                time.sleep(delay)
+                continue
+            # The body has been read by now (no stream=True), so this is the full request time
+            METRICS.observe_histogram('http_latency', time.perf_counter() - start)
+            METRICS.count('http_requests')
+            METRICS.count('bytes_fetched', len(response.content))
+
+            if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                return response
+
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            delay = min(MAX_BACKOFF, retry_after) if retry_after is not None else self.backoff(attempt)
+            METRICS.count('http_retries')
+            logger.warning('Retryable status, retrying', extra={'url': url, 'status': response.status_code, 'delay_s': delay})
+            response.close()
+            time.sleep(delay)
+
+    def close(self):
+        with self.lock:
+            self._close_session()
+
+    def _close_session(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def reset_after_fork(self):
+        # A forked process gets a copy of the parent's keep-alive sockets, which must not be used
+        # by two processes. The child drops them (without closing them for the parent) and opens its own
+        self.lock = threading.Lock()
+        self.session = None
+
+# Shared by the scraper and the DB loader so that a whole crawl reuses the same few connections
+CLIENT = HttpClient()
+if hasattr(os, 'register_at_fork'): # not on Windows, where processes are spawned
+    os.register_at_fork(after_in_child=CLIENT.reset_after_fork)
+
+def configure(timeout=None, max_retries=None, backoff_factor=None, pool_size=None, cache=None):
+    CLIENT.configure(timeout, max_retries, backoff_factor, pool_size, cache)
+
+def get(url, **kwargs):
+    return CLIENT.get(url, **kwargs)
@@ -0,0 +1,161 @@
+import multiprocessing
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+from metrics import METRICS
+
+WEBP_QUALITY = 80 # Pillow's default WEBP quality
+WEBP_METHOD = 4 # 0 (fast) to 6 (slower, smaller files)
+MAX_PENDING = 64 # images waiting for a worker before the crawl is slowed down
+# Workers are started by a clean server process instead of being forked from the crawl: the first
+# image is submitted by a scraping thread, and a fork while another thread holds a lock (metrics,
+# logging) would leave that lock held forever in the worker
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Sizes written for every card scan: longest side in pixels (None keeps the scan as it is) and the
+# WEBP settings. Small sizes are shown many at a time, so they trade detail for bytes with a lower
+# quality and the slowest (smallest) method
+ImageSize = namedtuple('ImageSize', ['max_side', 'quality', 'method'])
+FULL_SIZE = 'full'
+CARD_IMAGE_SIZES = {
+    'thumb': ImageSize(200, 70, 6),
+    'medium': ImageSize(600, 75, 6),
+    FULL_SIZE: ImageSize(None, WEBP_QUALITY, WEBP_METHOD),
+}
+
+def derivative_path(file_path, size):
+    # The full size keeps the path of the image, the others get the size before the extension
+    if size == FULL_SIZE:
+        return file_path
+    root, extension = os.path.splitext(file_path)
+    return f'{root}.{size}{extension}'
+
+def derivative_paths(file_path, sizes):
+    return {size: derivative_path(file_path, size) for size in sizes}
+
+def write_file(file_path, data):
+    # Written under another name first and renamed, so a crash never leaves a truncated image that
+    # image_store.ImageStore.is_current would take for a complete one
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, file_path)
+
+def save_image_to_file(image_data, file_path, format='WEBP', quality=WEBP_QUALITY, method=WEBP_METHOD):
+    # Returns the seconds spent, so ImageEncoder can record the time of its worker processes
+    start = time.perf_counter()
+    # Convert image_data to a BytesIO object if it's not already one
+    if not isinstance(image_data, BytesIO):
+        image_data = BytesIO(image_data)
+
+    # Open the image using PIL
+    image = Image.open(image_data)
+
+    # Convert the image to WebP format
+    image_webp_data = BytesIO()
+    if format == 'WEBP':
+        image.save(image_webp_data, format=format, quality=quality, method=method)
+    else:
+        image.save(image_webp_data, format=format)
+
+    # Save the WebP image data to the file
+    write_file(file_path, image_webp_data.getvalue())
+
+    elapsed = time.perf_counter() - start
+    record_encode(elapsed)
+    return elapsed
+
+def save_image_derivatives(image_data, file_path, sizes=CARD_IMAGE_SIZES):
+    # Decodes the image once and writes one WEBP file per size, see derivative_path. The full size
+    # is written last, so once file_path exists every other size does too. Returns the seconds spent
+    start = time.perf_counter()
+    if not isinstance(image_data, BytesIO):
+        image_data = BytesIO(image_data)
+    image = Image.open(image_data)
+    image.load()
+
+    for size in sorted(sizes, key=lambda size: size == FULL_SIZE):
+        max_side, quality, method = sizes[size]
+        resized = image
+        if max_side and max(image.size) > max_side:
+            resized = image.copy()
+            resized.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=2.0)
+        image_webp_data = BytesIO()
+        resized.save(image_webp_data, format='WEBP', quality=quality, method=method)
+        write_file(derivative_path(file_path, size), image_webp_data.getvalue())
+
+    elapsed = time.perf_counter() - start
+    record_encode(elapsed)
+    return elapsed
+
+def record_encode(elapsed):
+    METRICS.observe('save_image_to_file', elapsed)
+    METRICS.count('images_encoded')
+
+class ImageEncoder:
+    # Decoding and re-encoding card scans is CPU bound, so it runs on a pool of processes
+    # instead of the scraping threads. At most max_pending images are queued at a time
+    def __init__(self, max_workers=None, quality=WEBP_QUALITY, method=WEBP_METHOD, max_pending=MAX_PENDING):
+        self.max_workers = max_workers or os.cpu_count()
+        self.quality = quality
+        self.method = method
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context(START_METHOD))
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.submitted = {} # group -> futures since its last flush
+        self.lock = threading.Lock()
+
+    def submit(self, image_data, file_path, sizes=None, group=None):
+        # With sizes every derivative of the image is written, see save_image_derivatives. group (e.g.
+        # the set id) lets flush wait for the images of one set while other sets are being crawled.
+        # Returns the future of the encode
+        if isinstance(image_data, BytesIO):
+            image_data = image_data.getvalue()
+        self.slots.acquire()
+        if sizes:
+            future = self.executor.submit(save_image_derivatives, image_data, file_path, sizes)
+        else:
+            future = self.executor.submit(save_image_to_file, image_data, file_path, 'WEBP', self.quality, self.method)
+        future.add_done_callback(self.done)
+        with self.lock:
+            self.submitted.setdefault(group, []).append(future)
+        return future
+
+    def done(self, future):
+        self.slots.release()
+        # Metrics recorded by the worker stay in its process, they are recorded again here
+        if not future.cancelled() and future.exception() is None:
+            record_encode(future.result())
+
+    def flush(self, group=None):
+        # Barrier: returns once every image submitted for group (every image without one) has been
+        # written, raising the first failure
+        with self.lock:
+            if group is None:
+                submitted = [future for futures in self.submitted.values() for future in futures]
+                self.submitted = {}
+            else:
+                submitted = self.submitted.pop(group, [])
+        error = None
+        for future in submitted:
+            if future.exception() is not None and error is None:
+                error = future.exception()
+        if error is not None:
+            raise error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
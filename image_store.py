@@ -0,0 +1,140 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+from io import BytesIO
+
+from image_pipeline import derivative_paths
+
+def image_paths(path, sizes):
+    # Every file written for path, its derivatives if it has sizes
+    return list(derivative_paths(path, sizes).values()) if sizes else [path]
+
+class ImageStore:
+    # Manifest of every image written by the scraper: output path -> source url and sha256 of the
+    # downloaded bytes. Images whose source is unchanged are neither downloaded nor encoded again,
+    # and identical sources are encoded once and hard-linked to the other paths. Images saved with
+    # sizes (see image_pipeline.save_image_derivatives) are current only if every derivative is on disk
+    def __init__(self, manifest_path):
+        os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(manifest_path, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS images (
+                path TEXT PRIMARY KEY,
+                url TEXT,
+                source_hash TEXT NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS images_source_hash ON images (source_hash)')
+        self.conn.commit()
+        self.encoding = {} # source_hash -> path being encoded, not necessarily on disk yet
+        self.futures = {} # path -> future of its encode, when encode returned one
+        self.deferred_links = [] # (source path, link path, sizes, group) waiting for the source to be encoded
+
+    def is_current(self, url, path, sizes=None):
+        # True if path was written from url and is still on disk, so there is nothing to download
+        with self.lock:
+            row = self.conn.execute('SELECT url FROM images WHERE path = ?', (path,)).fetchone()
+        return row is not None and row[0] == url and all(os.path.exists(file_path) for file_path in image_paths(path, sizes))
+
+    def save(self, url, image_data, path, encode, sizes=None, group=None):
+        # encode(image_data, path) is only called if no identical source has been stored yet, it may
+        # return the future of an asynchronous encode. group is the one given to flush
+        if isinstance(image_data, BytesIO):
+            image_data = image_data.getvalue()
+        source_hash = hashlib.sha256(image_data).hexdigest()
+        with self.lock:
+            row = self.conn.execute('SELECT source_hash FROM images WHERE path = ?', (path,)).fetchone()
+            on_disk = all(os.path.exists(file_path) for file_path in image_paths(path, sizes))
+            if row is not None and row[0] == source_hash and (on_disk or self.encoding.get(source_hash) == path):
+                self._record(path, url, source_hash)
+                return
+            source_path = self.encoding.get(source_hash)
+            if source_path is None:
+                for (candidate,) in self.conn.execute('SELECT path FROM images WHERE source_hash = ? AND path != ?', (source_hash, path)):
+                    if all(os.path.exists(file_path) for file_path in image_paths(candidate, sizes)):
+                        source_path = candidate
+                        break
+            if source_path is None:
+                self.encoding[source_hash] = path
+            else:
+                self.deferred_links.append((source_path, path, sizes, group))
+            self._record(path, url, source_hash)
+        if source_path is None:
+            try:
+                future = encode(image_data, path)
+            except BaseException:
+                self.forget(source_hash, path)
+                raise
+            if future is not None:
+                with self.lock:
+                    self.futures[path] = future
+                future.add_done_callback(lambda future: self.encode_done(future, source_hash, path))
+
+    def encode_done(self, future, source_hash, path):
+        if future.cancelled() or future.exception() is not None:
+            self.forget(source_hash, path)
+
+    def forget(self, source_hash, path):
+        # The encode of path failed: the next save of the same source encodes it again, and the links
+        # waiting for it are dropped by flush
+        with self.lock:
+            if self.encoding.get(source_hash) == path:
+                del self.encoding[source_hash]
+
+    def _record(self, path, url, source_hash):
+        self.conn.execute('INSERT OR REPLACE INTO images (path, url, source_hash) VALUES (?, ?, ?)', (path, url, source_hash))
+        self.conn.commit()
+
+    def flush(self, group=None):
+        # Called once the encoder has written the images of group (every group without one). Sets
+        # crawled at the same time share the store: the links of group wait for their source even if
+        # another set is encoding it, and the links of the other groups are left for their own flush
+        with self.lock:
+            links = [link for link in self.deferred_links if group is None or link[3] == group]
+            self.deferred_links = [link for link in self.deferred_links if not (group is None or link[3] == group)]
+            sources = [self.futures.get(source_path) for source_path, path, sizes, link_group in links]
+        error = None
+        for future in sources:
+            if future is not None and future.exception() is not None and error is None:
+                error = future.exception()
+        with self.lock:
+            self.encoding = {source_hash: path for source_hash, path in self.encoding.items() if not os.path.exists(path)}
+            waiting = set(self.encoding.values())
+            self.deferred_links += [link for link in links if link[0] in waiting]
+            # Futures are kept as long as a link may still wait for them
+            needed = {link[0] for link in self.deferred_links}
+            self.futures = {path: future for path, future in self.futures.items() if not future.done() or path in needed}
+        for source_path, path, sizes, link_group in links:
+            if source_path in waiting or os.path.abspath(source_path) == os.path.abspath(path):
+                continue
+            source_files = image_paths(source_path, sizes)
+            if not all(os.path.exists(source_file) for source_file in source_files):
+                continue # the source failed to encode, its error is raised below
+            for source_file, link in zip(source_files, image_paths(path, sizes)):
+                link_file(source_file, link)
+        if error is not None:
+            raise error
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def link_file(source_path, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source_path, tmp_path)
+    except OSError:
+        shutil.copyfile(source_path, tmp_path) # filesystems without hard links
+    os.replace(tmp_path, path)
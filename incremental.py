@@ -0,0 +1,92 @@
+import logging
+import os
+import re
+
+from csv_rows import read_card_rows
+from metrics import METRICS, timed
+from pipeline import stream_set, QUEUE_SIZE, BATCH_SIZE, IMAGES_PATH
+from pokellector_scraper import cards_csv_path
+
+CARD_NUMBER_PATTERN = re.compile(r'Card-([a-zA-Z]*\d+[a-zA-Z]*)$') # same suffix as CARD_URL_PATH_PATTERN
+UNNUMBERED_PATTERN = re.compile(r'^unnumbered_(\d+)$') # numbers given to the cards without one
+
+logger = logging.getLogger(__name__)
+
+def card_number_from_url(card_url):
+    # Card pages end with Card-<number>, e.g. /Pikachu-Super-Electric-Breaker-Card-12
+    match = CARD_NUMBER_PATTERN.search(card_url.rstrip('/'))
+    return match.group(1) if match else None
+
+def previous_cards_path(save_path, set_id):
+    # The cards CSV of the last run, moved to 'processed cards' once it was loaded
+    path = cards_csv_path(save_path, set_id)
+    processed_path = os.path.join(os.path.dirname(path), 'processed cards', os.path.basename(path))
+    for candidate in (path, processed_path):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+def card_from_row(row):
+    return {
+        'card_name': row.card_name,
+        'jpn_name': row.jpn_name,
+        'rarity': row.rarity,
+        'number': row.number,
+        'alternate versions': row.alternate_versions,
+        'image': row.image,
+        'image_paths': row.image_paths,
+        'url': row.url,
+    }
+
+def previous_cards(save_path, set_id):
+    path = previous_cards_path(save_path, set_id)
+    if path is None:
+        return []
+    # Written by CardsCsvWriter, so read back as utf-8 to copy the rows unchanged
+    return [card_from_row(row) for row in read_card_rows(path, encoding='utf-8')]
+
+def stored_card_numbers(db, expansion):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT number FROM CardType WHERE expansion = %s', (expansion,))
+        numbers = {row[0] for row in cursor.fetchall()}
+        cursor.close()
+    return numbers
+
+def next_unnumbered_index(cards, stored_numbers):
+    # The new unnumbered cards come after the ones of the previous CSV, which populate_cardtype numbers
+    # first once the CSV is rewritten, and after the ones already stored, so the upsert never
+    # overwrites a different card
+    used = sum(1 for card in cards if not card['number'])
+    for number in stored_numbers:
+        match = UNNUMBERED_PATTERN.match(number)
+        if match:
+            used = max(used, int(match.group(1)))
+    return used + 1
+
+def new_card_urls(card_urls, known_urls, known_numbers):
+    # A card is known if its page was scraped before or its number is already stored.
+    # Urls without a recognisable number are always fetched, the upsert makes that harmless
+    return [
+        card_url for card_url in card_urls
+        if card_url not in known_urls and card_number_from_url(card_url) not in known_numbers
+    ]
+
+@timed('update_set')
+def update_set(set_info, card_urls, save_path, is_jap, max_workers=8, journal=None, db=None, sets_dict=None, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE,
+               images_path=IMAGES_PATH):
+    # Incremental version of stream_set for sets that were scraped before: only the card pages that
+    # are not in the previous CSV (or in CardType) are fetched, and the expansion and the new cards are
+    # upserted. The new CSV has the previous rows followed by the new ones; if only the database
+    # knows the set, it only has the new cards
+    set_id = set_info[0]
+    cards = previous_cards(save_path, set_id)
+    known_urls = {card['url'] for card in cards if card['url']}
+    stored_numbers = stored_card_numbers(db, set_id) if db else set()
+    known_numbers = {card['number'] for card in cards if card['number']} | stored_numbers
+
+    new_urls = new_card_urls(card_urls, known_urls, known_numbers)
+    METRICS.count('cards_skipped', len(card_urls) - len(new_urls))
+    logger.info('Updating set', extra={'set_id': set_id, 'new_cards': len(new_urls), 'known_cards': len(card_urls) - len(new_urls)})
+    return stream_set(set_info, new_urls, save_path, is_jap, max_workers, journal, db, sets_dict, queue_size, batch_size,
+                      upsert=True, previous_cards=cards, unnumbered_start=next_unnumbered_index(cards, stored_numbers), images_path=images_path)
@@ -0,0 +1,68 @@
+import threading
+
+# kind -> (table, column) of the small lookup tables every card references
+LOOKUP_TABLES = {
+    'illustrator': ('Illustrator', 'name'),
+    'rarity': ('Rarity', 'name'),
+    'version': ('AlternateVersion', 'version'),
+}
+
+class LookupCache:
+    # In-process copy of the Illustrator, Rarity and AlternateVersion values, so repeated values
+    # never hit the database again. Values inserted by a transaction that is not committed yet are
+    # only visible to its own connection, and are dropped if it rolls back
+    def __init__(self):
+        self.known = {kind: set() for kind in LOOKUP_TABLES}
+        self.pending = {} # id(connection) -> kind -> values inserted in the open transaction
+        self.lock = threading.Lock()
+
+    def preload(self, cursor):
+        for kind, (table, column) in LOOKUP_TABLES.items():
+            cursor.execute(f'SELECT {column} FROM {table}')
+            values = {row[0] for row in cursor.fetchall()}
+            with self.lock:
+                self.known[kind].update(values)
+
+    def missing(self, conn, kind, values):
+        with self.lock:
+            pending = self.pending.get(id(conn), {}).get(kind, ())
+            return [value for value in dict.fromkeys(values) if value not in self.known[kind] and value not in pending]
+
+    def added(self, conn, kind, values):
+        with self.lock:
+            self.pending.setdefault(id(conn), {}).setdefault(kind, set()).update(values)
+
+    def commit(self, conn):
+        with self.lock:
+            for kind, values in self.pending.pop(id(conn), {}).items():
+                self.known[kind].update(values)
+
+    def rollback(self, conn):
+        with self.lock:
+            self.pending.pop(id(conn), None)
+
+_caches = {} # one cache per database, shared by every connection to it
+_caches_lock = threading.Lock()
+
+def get_lookup_cache(cursor):
+    # The first call for a database preloads the lookup tables
+    dsn = cursor.connection.dsn
+    with _caches_lock:
+        cache = _caches.get(dsn)
+        if cache is None:
+            cache = LookupCache()
+            cache.preload(cursor)
+            _caches[dsn] = cache
+    return cache
+
+def commit(conn):
+    conn.commit()
+    cache = _caches.get(conn.dsn)
+    if cache is not None:
+        cache.commit(conn)
+
+def rollback(conn):
+    conn.rollback()
+    cache = _caches.get(conn.dsn)
+    if cache is not None:
+        cache.rollback(conn)
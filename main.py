@@ -1,69 +1,371 @@
-
-import time
 import os
+import sys
+import json
+import argparse
+import logging
+import multiprocessing
+from contextlib import contextmanager, ExitStack
+
+from metrics import METRICS, configure_logging
 
-from pokellector_scraper import scrape_card_info, save_data, scrape_set
-from populate_db import populate_expansion_table, insert_jp_language, insert_eu_languages
+# Only the standard library (and metrics) is imported here, the scraper, the loader and their
+# dependencies (PIL, bs4, lxml, requests, psycopg2, pandas, pyarrow) are imported by the commands
+# that use them, so quick commands like `pending` start without loading any of them
 
 POKELLECTOR_URL = 'https://www.pokellector.com/'
 DB_PARAMS = {
 ...
 }
+MAX_WORKERS = 8 # number of card pages scraped concurrently
+REQUESTS_PER_SECOND = 2 # per-host request budget
+BURST = 4 # requests that can be sent back to back before the rate limit kicks in
+HTTP_TIMEOUT = (10, 30) # connect and read timeouts in seconds
+HTTP_MAX_RETRIES = 4 # retries on connection errors, 429 and 5xx responses
+HTTP_CACHE_TTL = 7 * 24 * 3600 # seconds before a cached page or image is revalidated with a conditional GET
+HTTP_CACHE_MAX_SIZE = 2 * 1024 ** 3 # bytes kept in the response cache
+DB_QUEUE_SIZE = 64 # scraped cards waiting to be inserted before the crawl is slowed down
+DB_BATCH_SIZE = 50 # cards inserted with a single statement per table
+DB_POOL_SIZE = 4 # database connections shared by the whole run
+IMAGE_WORKERS = os.cpu_count() # processes encoding card images to WEBP
+WEBP_QUALITY = 80
+WEBP_METHOD = 4 # 0 (fast) to 6 (slower, smaller files)
+LOG_JSON = False # one JSON object per log line instead of key=value pairs
+METRICS_FILE = 'metrics.json' # timers and counters of the run, written in save_path
+SET_WORKERS = 4 # sets crawled at the same time by crawl_catalogue
+CATALOGUE_QUEUE_FILE = 'catalogue_queue.sqlite' # work queue of crawl_catalogue, written in save_path
+SHARD_PROCESSES = os.cpu_count() # worker processes started by crawl_sharded
+COLUMNAR_FORMAT = None # 'parquet' or 'arrow' to also write the scraped sets to datasets in save_path/columnar (needs pyarrow)
+COLUMNAR_DIR = 'columnar'
+IMAGES_PATH = './expansion_images' # where the scraper saves the images, the loader finds them and stores their paths under it
+CARD_INDEX_FILE = 'card_index.sqlite' # search index of the card names, written in save_path
+
+def configure_http(state_path, pool_size, requests_per_second=REQUESTS_PER_SECOND):
+    from rate_limiter import configure_rate_limit
+    from http_cache import ResponseCache
+    import http_client
+    configure_rate_limit(requests_per_second, BURST)
+    cache = ResponseCache(os.path.join(state_path, 'http_cache'), ttl=HTTP_CACHE_TTL, max_size=HTTP_CACHE_MAX_SIZE)
+    http_client.configure(timeout=HTTP_TIMEOUT, max_retries=HTTP_MAX_RETRIES, pool_size=pool_size, cache=cache)
+
+@contextmanager
+def crawl_environment(save_path, set_workers=1, use_db=True, state_path=None, requests_per_second=REQUESTS_PER_SECOND, image_workers=IMAGE_WORKERS,
+                      use_index=True, images_path=None):
+    # Rate limit, HTTP client, database pool and image pipeline shared by every set of the run,
+    # yields the database (None without use_db). state_path, save_path by default, keeps the HTTP cache,
+    # the image manifest and the metrics of the run, which are written even if it fails.
+    # images_path (IMAGES_PATH by default) is where the scraper saves the images
+    import pokellector_scraper
+    from pokellector_scraper import set_image_encoder, set_image_store, flush_images, set_columnar_sink, set_card_index
+    from image_pipeline import ImageEncoder
+    from image_store import ImageStore
+    from db_pool import Database
+    from columnar import ColumnarSink
+    from card_index import CardIndex
+
+    state_path = state_path or save_path
+    configure_http(state_path, MAX_WORKERS * set_workers, requests_per_second)
+    pokellector_scraper.IMAGES_PATH = images_path or IMAGES_PATH
+
+    METRICS.reset()
+    try:
+        with ExitStack() as stack:
+            # Every set being crawled keeps two connections (its cards and their lookup values), plus one for everything else
+            db = stack.enter_context(Database(DB_PARAMS, max_connections=max(DB_POOL_SIZE, 2 * set_workers + 1))) if use_db else None
+            image_encoder = stack.enter_context(ImageEncoder(image_workers, WEBP_QUALITY, WEBP_METHOD))
+            image_store = stack.enter_context(ImageStore(os.path.join(state_path, 'image_manifest.sqlite')))
+            if use_index:
+                # Card names of every saved set, searched with `main.py search`
+                set_card_index(stack.enter_context(CardIndex(os.path.join(save_path, CARD_INDEX_FILE))))
+            set_image_encoder(image_encoder)
+            # Images already on disk from the same source are not downloaded or encoded again
+            set_image_store(image_store)
+            if COLUMNAR_FORMAT:
+                set_columnar_sink(ColumnarSink(os.path.join(save_path, COLUMNAR_DIR), COLUMNAR_FORMAT))
+            try:
+                yield db
+                flush_images()
+            finally:
+                set_image_encoder(None)
+                set_image_store(None)
+                set_columnar_sink(None)
+                set_card_index(None)
+    finally:
+        # Written even if the run fails, to see where it spent its time
+        METRICS.write_summary(os.path.join(state_path, METRICS_FILE))
 
 def scrape_and_populate(expansions, save_path):
-    ## LIST SET SCRAPER
-    wait_time = 1
+    '''expansions is a list of dictionaries where:
+        url: is the pokellector url of the expansion without the domain, IE,'/Base-Set-Expansion/',
+        generation: is the generation of the corresponding expansion, IE, 'Scarlet & Violet',
+        italian_name: is the italian name of the expansion. Must be empty if is_jap is True,
+        is_jap: is a boolean that specifies whether the corresponding expansion is japanese,
+        update: (optional) if True the expansion was already scraped and only its new cards are fetched and upserted
+    '''
+    from catalogue import crawl_set
+    from populate_db import assign_expansion_languages
 
+    ## LIST SET SCRAPER
     # Check consistency
     for expansion_dict in expansions:
         italian_name = expansion_dict.get('italian_name', '') # either get the value or sets it to empty string
         is_jap = expansion_dict['is_jap']
         assert (not is_jap or (len(italian_name) == 0)), 'A japanese expansion cannot have an italian name'
 
-    for expansion_dict in expansions:
-        data = {}
-        set_url = expansion_dict['url']
-        generation = expansion_dict['generation']
-        italian_name = expansion_dict.get('italian_name', '') # either get the value or sets it to empty string
-        is_jap = expansion_dict['is_jap']
+    with crawl_environment(save_path) as db:
+        for expansion_dict in expansions:
+            set_url = expansion_dict['url']
+            generation = expansion_dict['generation']
+            italian_name = expansion_dict.get('italian_name', '') # either get the value or sets it to empty string
+            is_jap = expansion_dict['is_jap']
+
+            # Scraping + saving info
+            crawl_set(POKELLECTOR_URL+set_url, generation, is_jap, save_path, italian_name, expansion_dict.get('update', False), db,
+                      MAX_WORKERS, DB_QUEUE_SIZE, DB_BATCH_SIZE, IMAGES_PATH)
+
+        # Languages of every new expansion, in one statement
+        assign_expansion_languages(db)
+
+def crawl_catalogue(save_path, languages=(False, True), set_workers=SET_WORKERS, update=False):
+    # Every set listed on pokellector (languages are is_jap values) goes through a work queue kept in
+    # save_path, so running this again after a crash or a stop only crawls the sets that were not done
+    from work_queue import WorkQueue
+    from catalogue import discover_sets, CatalogueCrawler
+    from populate_db import assign_expansion_languages
+
+    with WorkQueue(os.path.join(save_path, CATALOGUE_QUEUE_FILE)) as queue, crawl_environment(save_path, set_workers) as db:
+        for is_jap in languages:
+            discover_sets(queue, is_jap)
+        counts = CatalogueCrawler(queue, save_path, db, set_workers, MAX_WORKERS, update, DB_QUEUE_SIZE, DB_BATCH_SIZE, IMAGES_PATH).run()
+        assign_expansion_languages(db)
+    return counts
+
+def pending_sets(save_path):
+    # (status counts, urls of the sets still to crawl) of the catalogue queue, without touching the network
+    from work_queue import WorkQueue, PENDING, RUNNING, FAILED
+    path = os.path.join(save_path, CATALOGUE_QUEUE_FILE)
+    if not os.path.exists(path):
+        return {}, []
+    with WorkQueue(path) as queue:
+        return queue.counts(), [(status, key) for status in (RUNNING, PENDING, FAILED) for key in queue.keys(status)]
+
+# Sharded crawl: on one box crawl_sharded does everything. On several boxes sharing save_path, call
+# seed_shards once, run_shard_worker on every box (as many processes as wanted), then merge_sharded and
+# load the merged CSVs with populate_expansion_table
+def seed_shards(save_path, languages=(False, True), expansions=None):
+    # Queues the given expansions (same dicts as scrape_and_populate) or the whole catalogue
+    from sharded import open_queue, seed_queue, shards_path
+    from catalogue import discover_sets
+
+    configure_http(shards_path(save_path), MAX_WORKERS)
+    if expansions is not None:
+        seed_queue(save_path, [
+            {'url': POKELLECTOR_URL + expansion_dict['url'], 'generation': expansion_dict['generation'],
+             'italian_name': expansion_dict.get('italian_name', ''), 'is_jap': expansion_dict['is_jap']}
+            for expansion_dict in expansions
+        ])
+        return
+    with open_queue(save_path) as queue:
+        for is_jap in languages:
+            discover_sets(queue, is_jap)
+
+def merge_sharded(save_path, partial=False):
+    # The columnar datasets and the card index are written by the merge, not by the workers
+    from pokellector_scraper import set_columnar_sink, set_card_index
+    from sharded import merge_shards
+    from columnar import ColumnarSink
+    from card_index import CardIndex
+
+    if COLUMNAR_FORMAT:
+        set_columnar_sink(ColumnarSink(os.path.join(save_path, COLUMNAR_DIR), COLUMNAR_FORMAT))
+    try:
+        with CardIndex(os.path.join(save_path, CARD_INDEX_FILE)) as index:
+            set_card_index(index)
+            return merge_shards(save_path, partial)
+    finally:
+        set_columnar_sink(None)
+        set_card_index(None)
+
+def run_shard_worker(save_path, worker_id=None, requests_per_second=REQUESTS_PER_SECOND, image_workers=IMAGE_WORKERS, images_path=None):
+    # The rate limit is per process, crawl_sharded splits the budget between its processes. images_path
+    # is passed explicitly, a spawned process would not see the value main() set
+    from sharded import ShardWorker, shards_path, default_worker_id
+
+    worker_id = worker_id or default_worker_id()
+    state_path = os.path.join(shards_path(save_path), worker_id)
+    with crawl_environment(save_path, use_db=False, state_path=state_path, requests_per_second=requests_per_second, image_workers=image_workers,
+                           use_index=False, images_path=images_path):
+        ShardWorker(save_path, worker_id, MAX_WORKERS).run()
+
+def crawl_sharded(save_path, processes=SHARD_PROCESSES, languages=(False, True), expansions=None):
+    import http_client
+
+    seed_shards(save_path, languages, expansions)
+    # The workers open their own connections, the ones used to seed the queue are not needed anymore
+    http_client.CLIENT.close()
+    # Image encoding is spread over the processes instead of a pool in each one
+    image_workers = max(1, IMAGE_WORKERS // processes)
+    workers = [
+        multiprocessing.Process(target=run_shard_worker, args=(save_path, None, REQUESTS_PER_SECOND / processes, image_workers, IMAGES_PATH))
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return merge_sharded(save_path)
+
+def load_scraped(save_path, is_jap, workers=0, bulk=False, upsert=False, all_sets_path=None, columnar_format=None):
+    # Loads the CSVs in save_path/sets and save_path/cards (or the columnar datasets) into the database
+    from db_pool import Database
+    from populate_db import populate_expansion_table, populate_expansion_table_parallel, create_sets_dictionary
 
-        # Scraping + saving info
-        set_id, set_name, number_of_cards, number_of_secret_cards, formatted_release_date, card_urls, icon_image, symbol_image = scrape_set(POKELLECTOR_URL+set_url)
-        data[set_id] = {}
-        data[set_id]['info'] = [set_id, set_name, number_of_cards, number_of_secret_cards, formatted_release_date, icon_image, symbol_image, generation, italian_name]
-        data[set_id]['cards'] = []
-        for card_url in card_urls:
-            card_info = scrape_card_info(card_url, set_id)
-            data[set_id]['cards'].append(card_info)
-            time.sleep(wait_time)
-        save_data(data, save_path, is_jap)
-        data = {}
-
-        sets_path = save_path + '/sets/'
-        all_cards_path = save_path + '/cards/'
-
-        # Actual populate of the database
-        populate_expansion_table(DB_PARAMS, sets_path, all_cards_path, is_jap)
-
-        if is_jap:
-            insert_jp_language(DB_PARAMS)
+    with Database(DB_PARAMS, max_connections=max(DB_POOL_SIZE, workers)) as db:
+        sets_path = os.path.join(save_path, 'sets')
+        cards_path = os.path.join(save_path, 'cards')
+        if columnar_format:
+            from columnar import populate_from_columnar
+            sets_dict = create_sets_dictionary(all_sets_path) if all_sets_path else None
+            populate_from_columnar(db, os.path.join(save_path, COLUMNAR_DIR), is_jap, columnar_format, sets_dict, upsert, IMAGES_PATH)
+        elif workers:
+            populate_expansion_table_parallel(db, sets_path, cards_path, is_jap, all_sets_path, workers, upsert, IMAGES_PATH)
         else:
-            insert_eu_languages(DB_PARAMS)
+            populate_expansion_table(db, sets_path, cards_path, is_jap, all_sets_path, bulk, upsert, IMAGES_PATH)
+
+def build_bundle(save_path, bundle_path, is_jap, all_sets_path=None):
+    # COPY files and restore.sql for the CSVs in save_path/sets and save_path/cards, see restore_bundle
+    from restore_bundle import build_restore_bundle
+    return build_restore_bundle(bundle_path, [(os.path.join(save_path, 'sets'), os.path.join(save_path, 'cards'), is_jap)], all_sets_path, IMAGES_PATH)
+
+def search_cards(save_path, query, limit=20, is_jap=None, rebuild=False):
+    # Matches of query in the card index of save_path, rebuilt from the CSVs first if asked
+    from card_index import CardIndex, index_saved_sets
+    with CardIndex(os.path.join(save_path, CARD_INDEX_FILE)) as index:
+        if rebuild:
+            index_saved_sets(index, save_path)
+        return index.search(query, limit, is_jap)
+
+def assign_languages():
+    from db_pool import Database
+    from populate_db import assign_expansion_languages
+
+    with Database(DB_PARAMS) as db:
+        return assign_expansion_languages(db)
+
+# Command line
+
+def read_expansions(path):
+    # JSON list of the dicts described in scrape_and_populate
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def expansions_from_args(args):
+    expansions = read_expansions(args.expansions_file) if args.expansions_file else []
+    for url in args.urls:
+        expansions.append({'url': url, 'generation': args.generation, 'italian_name': args.italian_name, 'is_jap': args.jap, 'update': args.update})
+    return expansions
+
+def languages_from_args(args):
+    return [language == 'jap' for language in args.languages]
+
+def command_scrape(args):
+    expansions = expansions_from_args(args)
+    if not expansions:
+        sys.exit('No expansions, give their urls or --expansions-file')
+    scrape_and_populate(expansions, args.save_path)
+
+def command_load(args):
+    load_scraped(args.save_path, args.jap, args.workers, args.bulk, args.upsert, args.sets_dictionary, args.columnar)
+
+def command_bundle(args):
+    rows = build_bundle(args.save_path, args.output, args.jap, args.sets_dictionary)
+    print(f"{rows['card_expansion.tsv']} expansions and {rows['card_type.tsv']} cards written to {args.output}, "
+          f"load them with: cd {args.output} && psql -d <database> -f restore.sql")
+
+def command_languages(args):
+    print(f'{assign_languages()} expansion languages assigned')
+
+def command_crawl_all(args):
+    if args.processes:
+        merged = crawl_sharded(args.save_path, args.processes, languages_from_args(args))
+        print(f'{len(merged)} sets merged')
+    else:
+        counts = crawl_catalogue(args.save_path, languages_from_args(args), args.set_workers, args.update)
+        print(', '.join(f'{count} {status}' for status, count in sorted(counts.items())))
+
+def command_search(args):
+    is_jap = {'world': False, 'jap': True}.get(args.language)
+    for match in search_cards(args.save_path, args.query, args.limit, is_jap, args.rebuild):
+        print('\t'.join(str(value) if value is not None else '' for value in
+                        (match.expansion, match.number, match.card_name, match.jpn_name, match.rarity, match.expansion_name)))
+
+def command_pending(args):
+    counts, items = pending_sets(args.save_path)
+    print(', '.join(f'{count} {status}' for status, count in sorted(counts.items())) or 'No catalogue queue in ' + args.save_path)
+    for status, key in items:
+        print(f'{status}\t{key}')
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Scrapes pokellector and loads the cards in the database')
+    parser.add_argument('--save-path', default='.', help='folder of the scraped CSVs, queues, caches and metrics')
+    parser.add_argument('--images-path', default=IMAGES_PATH, help='folder the set and card images are saved in and loaded from')
+    parser.add_argument('--dsn', help='database connection string, instead of DB_PARAMS')
+    parser.add_argument('--log-json', action='store_true', default=LOG_JSON, help='one JSON object per log line')
+    parser.add_argument('--log-level', default='INFO')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    scrape = commands.add_parser('scrape', help='scrape expansions and load them while they are scraped')
+    scrape.add_argument('urls', nargs='*', help="expansion urls without the domain, e.g. '/Base-Set-Expansion/'")
+    scrape.add_argument('--expansions-file', help='JSON list of expansions, see scrape_and_populate')
+    scrape.add_argument('--generation', help='generation of the expansions given as urls')
+    scrape.add_argument('--italian-name', default='', help='italian name of the expansion given as url')
+    scrape.add_argument('--jap', action='store_true', help='the expansions given as urls are japanese')
+    scrape.add_argument('--update', action='store_true', help='only fetch and upsert the cards not scraped before')
+    scrape.set_defaults(run=command_scrape)
+
+    load = commands.add_parser('load', help='load the scraped CSVs (or columnar datasets) into the database')
+    load.add_argument('--jap', action='store_true', help='the sets to load are japanese')
+    load.add_argument('--workers', type=int, default=0, help='load the cards on this many connections, 0 loads them on one')
+    load.add_argument('--bulk', action='store_true', help='insert the cards of a set with a few statements instead of one per card')
+    load.add_argument('--upsert', action='store_true', help='update the sets and cards already stored')
+    load.add_argument('--sets-dictionary', help='spreadsheet of the italian expansion names')
+    load.add_argument('--columnar', choices=('parquet', 'arrow'), help='load the columnar datasets instead of the CSVs')
+    load.set_defaults(run=command_load)
+
+    bundle = commands.add_parser('bundle', help='write the scraped CSVs as COPY files and a restore script, without a database')
+    bundle.add_argument('output', help='folder of the bundle')
+    bundle.add_argument('--jap', action='store_true', help='the sets to bundle are japanese')
+    bundle.add_argument('--sets-dictionary', help='spreadsheet of the italian expansion names')
+    bundle.set_defaults(run=command_bundle)
+
+    languages = commands.add_parser('languages', help='assign the languages of the expansions that have none')
+    languages.set_defaults(run=command_languages)
+
+    crawl_all = commands.add_parser('crawl-all', help='crawl every set of the catalogue, resuming the previous crawl')
+    crawl_all.add_argument('--languages', nargs='+', choices=('world', 'jap'), default=['world', 'jap'])
+    crawl_all.add_argument('--set-workers', type=int, default=SET_WORKERS)
+    crawl_all.add_argument('--update', action='store_true', help='only fetch and upsert the cards not scraped before')
+    crawl_all.add_argument('--processes', type=int, default=0, help='sharded crawl on this many processes, merged into CSVs without loading them')
+    crawl_all.set_defaults(run=command_crawl_all)
+
+    search = commands.add_parser('search', help='search the scraped cards by part of their English or Japanese name')
+    search.add_argument('query')
+    search.add_argument('--limit', type=int, default=20)
+    search.add_argument('--language', choices=('world', 'jap'), help='only search the world or the japanese sets')
+    search.add_argument('--rebuild', action='store_true', help='index the set CSVs in save_path first')
+    search.set_defaults(run=command_search)
+
+    pending = commands.add_parser('pending', help='list the sets the catalogue crawl has not finished')
+    pending.set_defaults(run=command_pending)
+    return parser
+
+def main(argv=None):
+    global DB_PARAMS, IMAGES_PATH
+    args = build_parser().parse_args(argv)
+    configure_logging(getattr(logging, args.log_level.upper()), json_lines=args.log_json)
+    if args.dsn:
+        DB_PARAMS = {'dsn': args.dsn}
+    IMAGES_PATH = args.images_path
+    args.run(args)
 
 if __name__ == '__main__':
-    '''List of dictionaries where:
-        url: is the pokellector url of the expansion without the domain, IE,'/Base-Set-Expansion/',
-        generation: is the generation of the corresponding expansion, IE, 'Scarlet & Violet',
-        italian_name: is the italian name of the expansion. Must be empty if is_jap is True,
-        is_jap: is a boolean that specifies whether the corresponding expansion is japanese
-    '''
-    expansions = [
-            {
-                'url' : '/Super-Electric-Breaker-Expansion/',
-                'generation': 'Scarlet & Violet',
-                #'italian_name' : 'Dragon Discovery',
-                'is_jap' : True
-            }]
-    
-    save_path = ... 
-    scrape_and_populate(expansions, save_path)
+    main()
@@ -0,0 +1,143 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the HTTP latency histogram, slower requests go in the last bucket
+HTTP_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Timer:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total_s': round(self.total, 6),
+            'mean_s': round(self.total / self.count, 6) if self.count else None,
+            'max_s': round(self.max, 6),
+        }
+
+class Histogram(Timer):
+    __slots__ = ('bounds', 'buckets')
+
+    def __init__(self, bounds):
+        super().__init__()
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+
+    def observe(self, seconds):
+        super().observe(seconds)
+        for index, bound in enumerate(self.bounds):
+            if seconds <= bound:
+                break
+        else:
+            index = len(self.bounds)
+        self.buckets[index] += 1
+
+    def summary(self):
+        labels = [f'<={bound}' for bound in self.bounds] + [f'>{self.bounds[-1]}']
+        return {**super().summary(), 'buckets': dict(zip(labels, self.buckets))}
+
+class Metrics:
+    # Counters and timers of a run, shared by the scraper, the image pipeline and the DB loader.
+    # Stages are timed with `with METRICS.timed('stage'):` or the @timed('stage') decorator
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.timers = {}
+            self.histograms = {}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = Timer()
+            timer.observe(seconds)
+
+    def observe_histogram(self, name, value, bounds=HTTP_LATENCY_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(bounds)
+            histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def summary(self):
+        with self.lock:
+            return {
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'elapsed_s': round(time.time() - self.started, 3),
+                'counters': dict(sorted(self.counters.items())),
+                'timers': {name: timer.summary() for name, timer in sorted(self.timers.items())},
+                'histograms': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+            }
+
+    def write_summary(self, path):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.summary(), file, indent=2)
+
+METRICS = Metrics()
+
+def timed(name):
+    return METRICS.timed(name)
+
+# Attributes every LogRecord has, anything else was passed with extra= and is a structured field
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class StructuredFormatter(logging.Formatter):
+    # Appends the extra= fields of a record as key=value pairs, or writes one JSON object per line
+    def __init__(self, json_lines=False):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = {key: value for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES}
+        if self.json_lines:
+            event = {
+                'time': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage(),
+                **fields,
+            }
+            if record.exc_info:
+                event['exception'] = self.formatException(record.exc_info)
+            return json.dumps(event, default=str)
+        line = super().format(record)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return line
+
+def configure_logging(level=logging.INFO, json_lines=False):
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter(json_lines))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
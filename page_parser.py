@@ -0,0 +1,42 @@
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml # only checks that the faster tree builder is installed
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+class RegionStrainer(SoupStrainer):
+    # Keeps only the tags with one of the given names or classes (with everything inside them),
+    # so the rest of the page never becomes part of the tree
+    def __init__(self, names=(), classes=()):
+        super().__init__()
+        self.region_names = frozenset(names)
+        self.region_classes = frozenset(classes)
+
+    def keeps(self, name, attrs):
+        if name in self.region_names:
+            return True
+        classes = (attrs or {}).get('class') or ()
+        if isinstance(classes, str):
+            classes = classes.split()
+        return not self.region_classes.isdisjoint(classes)
+
+    # bs4 >= 4.13
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return self.keeps(name, attrs)
+
+    def allow_string_creation(self, string):
+        return False
+
+    # bs4 < 4.13
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        return self.keeps(markup_name, markup_attrs)
+
+# Regions read by the extractors of each kind of page
+CARD_PAGE = RegionStrainer(names=['h1'], classes=['infoblurb', 'card', 'cardlisting'])
+SET_PAGE = RegionStrainer(names=['h1', 'meta', 'a', 'span', 'cite'], classes=['cards'])
+SET_LIST_PAGE = RegionStrainer(names=['a', 'h1'])
+
+def make_soup(markup, regions=None):
+    return BeautifulSoup(markup, PARSER, parse_only=regions)
@@ -0,0 +1,137 @@
+import os
+import queue
+import threading
+
+from pokellector_scraper import iter_cards, write_set_csv, set_csv_path, CardsCsvWriter, flush_images, export_columnar, index_cards
+from populate_db import insert_expansion, bulk_insert_cards, commit_card_lookups, get_super_expansion, move_file, parse_image_sizes, IMAGES_PATH
+from lookup_cache import commit, rollback
+from csv_rows import SetRow
+from metrics import timed
+
+QUEUE_SIZE = 64 # cards waiting to be inserted before the crawl is slowed down
+BATCH_SIZE = 50 # cards written to the database with a single statement per table
+_COMMIT = object()
+_ROLLBACK = object()
+
+class DatabaseSink(threading.Thread):
+    # Inserts the cards of a set on its own connection while the crawl is still running, its
+    # transaction stays open until the set is done. New lookup values are committed before every
+    # batch on a second connection, so the sets crawled at the same time never wait for each other.
+    # The queue is bounded, so a slow database slows the crawl down instead of piling up cards
+    def __init__(self, db, set_row, is_jap, sets_dict, super_expansion, source, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, upsert=False,
+                 unnumbered_start=1, images_path=IMAGES_PATH):
+        super().__init__(daemon=True)
+        self.db = db
+        self.set_row = set_row
+        self.is_jap = is_jap
+        self.sets_dict = sets_dict
+        self.super_expansion = super_expansion
+        self.source = source
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.unnumbered_start = unnumbered_start # index of the first unnumbered card, see incremental.next_unnumbered_index
+        self.images_path = images_path
+        self.ended = False
+        self.error = None
+
+    def run(self):
+        try:
+            with self.db.connection() as conn, self.db.connection() as lookup_conn:
+                self.load(conn, lookup_conn.cursor())
+        except Exception as e:
+            self.error = e
+            # Keep draining so the crawl never blocks on a full queue
+            while not self.ended:
+                self.ended = self.queue.get() in (_COMMIT, _ROLLBACK)
+
+    def load(self, conn, lookup_cursor):
+        cursor = conn.cursor()
+        expansion = self.set_row.id
+        expansion_path = insert_expansion(cursor, self.set_row, self.is_jap, self.sets_dict, self.super_expansion, self.source, upsert=self.upsert,
+                                          images_path=self.images_path)
+        unnumbered_index = self.unnumbered_start
+        batch = []
+        while True:
+            card = self.queue.get()
+            if card is _COMMIT or card is _ROLLBACK:
+                self.ended = True
+                break
+            if expansion_path is None:
+                continue # the expansion was not inserted, neither are its cards
+            number = card['number']
+            if not number:
+                number = 'unnumbered_'+str(unnumbered_index)
+                unnumbered_index += 1
+            batch.append((number, card['card_name'], card['rarity'], card.get('illustrator'), card['alternate versions'], parse_image_sizes(card.get('image_paths'))))
+            if len(batch) >= self.batch_size:
+                commit_card_lookups(lookup_cursor, batch)
+                bulk_insert_cards(cursor, expansion, batch, self.upsert, self.images_path)
+                batch = []
+        if card is _COMMIT:
+            commit_card_lookups(lookup_cursor, batch)
+            bulk_insert_cards(cursor, expansion, batch, self.upsert, self.images_path)
+            commit(conn)
+        else:
+            rollback(conn)
+
+    def put(self, card):
+        if self.error:
+            raise self.error
+        self.queue.put(card)
+
+    def finish(self, commit=True):
+        self.queue.put(_COMMIT if commit else _ROLLBACK)
+        self.join()
+        if self.error:
+            raise self.error
+
+def set_row_from_info(set_info):
+    # Same row populate_table_from_csv would read back from the set CSV, empty cells are missing values
+    return SetRow(*[value if value != '' else None for value in set_info])
+
+@timed('stream_set')
+def stream_set(set_info, card_urls, save_path, is_jap, max_workers=8, journal=None, db=None, sets_dict=None, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE,
+               upsert=False, previous_cards=(), unnumbered_start=1, images_path=IMAGES_PATH):
+    # Each card goes through scrape -> CSV row -> (optionally) database insert as soon as it is ready,
+    # so only the cards in flight are kept in memory. previous_cards are only copied to the CSV,
+    # see incremental.update_set. images_path is the folder the scraper saves the images in
+    set_id = set_info[0]
+    write_set_csv(save_path, set_id, set_info, is_jap)
+    set_path = set_csv_path(save_path, set_id)
+
+    sink = None
+    if db:
+        super_expansion = get_super_expansion(os.path.basename(set_path))
+        sink = DatabaseSink(db, set_row_from_info(set_info), is_jap, sets_dict, super_expansion, set_path, queue_size, batch_size, upsert,
+                            unnumbered_start, images_path)
+        sink.start()
+
+    new_cards = []
+    try:
+        with CardsCsvWriter(save_path, set_id) as writer:
+            for card in previous_cards:
+                writer.write(card)
+            for card in iter_cards(card_urls, set_id, max_workers, journal):
+                if not card:
+                    continue # scrape_card_info already reported the failure
+                writer.write(card)
+                if sink:
+                    sink.put(card)
+                new_cards.append(card)
+        flush_images(set_id)
+        # Cards are collected only for these, the CSV and the database get them one by one
+        export_columnar(set_info, list(previous_cards) + new_cards, is_jap)
+        index_cards(set_info, list(previous_cards) + new_cards, is_jap)
+    except BaseException:
+        if sink:
+            sink.queue.put(_ROLLBACK)
+            sink.join()
+        raise
+
+    if sink:
+        sink.finish()
+        # Same layout populate_expansion_table leaves behind once a set is loaded
+        move_file(set_path, os.path.join(os.path.dirname(set_path), 'processed sets'))
+        move_file(writer.path, os.path.join(os.path.dirname(writer.path), 'processed cards'))
+    return set_id
@@ -1,39 +1,108 @@
-from PIL import Image
 from requests.exceptions import MissingSchema
-import requests
-from bs4 import BeautifulSoup
 import re
 from urllib.parse import urlparse, urljoin
 from datetime import datetime
 from io import BytesIO
 import os  
 import csv
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+import http_client
+from image_pipeline import save_image_to_file, save_image_derivatives, derivative_paths, CARD_IMAGE_SIZES
+from page_parser import make_soup, CARD_PAGE, SET_PAGE, SET_LIST_PAGE
+from assets import AssetManifest
+from metrics import METRICS, timed
 
 IMAGES_PATH = ... # path to save the images of the cards and the set
+IMAGE_SIZES = CARD_IMAGE_SIZES # sizes written for every card scan, see image_pipeline
+IMAGE_ENCODER = None # see set_image_encoder
+IMAGE_STORE = None # see set_image_store
+COLUMNAR_SINK = None # see set_columnar_sink
+CARD_INDEX = None # see set_card_index
+
+# Patterns are compiled once instead of at every card
+INFO_LABELS = ('JPN', 'Rarity', 'Card')
+INFO_LABEL_PATTERNS = {label: re.compile(rf'\b{label}\b', re.IGNORECASE) for label in INFO_LABELS}
+RELEASE_DATE_PATTERN = re.compile(r'^(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) \d{1,2}(st|nd|rd|th)$')
+ORDINAL_SUFFIX_PATTERN = re.compile(r'(st|nd|rd|th)')
+CARD_URL_PATH_PATTERN = r'/.+Card-[a-zA-Z]*\d+[a-zA-Z]*$'
+
+logger = logging.getLogger(__name__)
 
 def download_media(url):
   try:
-    response = requests.get(url)
+    response = http_client.get(url)
     return BytesIO(response.content)
   except MissingSchema:
     return None
 
-def save_image_to_file(image_data, file_path, format='WEBP'):
-  # Convert image_data to a BytesIO object if it's not already one
-  if not isinstance(image_data, BytesIO):
-      image_data = BytesIO(image_data)
-
-  # Open the image using PIL
-  image = Image.open(image_data)
-
-  # Convert the image to WebP format
-  image_webp_data = BytesIO()
-  image.save(image_webp_data, format=format)
-
-  # Save the WebP image data to the file
-  with open(file_path, 'wb') as file:
-      file.write(image_webp_data.getvalue())
-
+def set_image_encoder(encoder):
+  # With an image_pipeline.ImageEncoder images are encoded by its worker processes,
+  # otherwise they are encoded inline by the scraping thread
+  global IMAGE_ENCODER
+  IMAGE_ENCODER = encoder
+
+def set_image_store(store):
+  # With an image_store.ImageStore unchanged images are not downloaded or encoded again
+  global IMAGE_STORE
+  IMAGE_STORE = store
+
+def set_columnar_sink(sink):
+  # With a columnar.ColumnarSink every saved set is also written to the Parquet/Arrow datasets
+  global COLUMNAR_SINK
+  COLUMNAR_SINK = sink
+
+def set_card_index(index):
+  # With a card_index.CardIndex the card names of every saved set are indexed for search
+  global CARD_INDEX
+  CARD_INDEX = index
+
+def index_cards(set_info, cards, is_jap):
+  if CARD_INDEX is not None:
+    CARD_INDEX.replace_set(set_info, cards, is_jap)
+
+def export_columnar(set_info, cards, is_jap):
+  if COLUMNAR_SINK is None:
+    return
+  for card in cards:
+    COLUMNAR_SINK.add_card(set_info[0], card)
+  COLUMNAR_SINK.write_set(set_info, is_jap)
+
+def is_image_current(url, file_path, sizes=None):
+  return IMAGE_STORE is not None and IMAGE_STORE.is_current(url, file_path, sizes)
+
+def encode_image(image_data, file_path, sizes=None, group=None):
+  # With sizes (card scans) every derivative is written from a single decode. Returns the future of
+  # the encode when it runs on the image encoder
+  if IMAGE_ENCODER is not None:
+    return IMAGE_ENCODER.submit(image_data, file_path, sizes, group)
+  elif sizes:
+    save_image_derivatives(image_data, file_path, sizes)
+  else:
+    save_image_to_file(image_data, file_path)
+
+def store_image(image_data, file_path, url=None, sizes=None, group=None):
+  # group is the set the image belongs to, see flush_images
+  if image_data is None: # the download failed
+    logger.warning('No image to save', extra={'path': file_path, 'url': url})
+    return
+  if IMAGE_STORE is not None:
+    IMAGE_STORE.save(url, image_data, file_path, lambda image_data, file_path: encode_image(image_data, file_path, sizes, group), sizes, group)
+  else:
+    encode_image(image_data, file_path, sizes, group)
+
+@timed('flush_images')
+def flush_images(group=None):
+  # Barrier: every image handed to store_image for group (e.g. a set id) has been written once this
+  # returns, the images of the sets crawled at the same time may still be encoding. Without a
+  # group it waits for every image
+  if IMAGE_ENCODER is not None:
+    IMAGE_ENCODER.flush(group)
+  if IMAGE_STORE is not None:
+    IMAGE_STORE.flush(group)
 
 def extract_alternative_versions(soup):
   # Initialize an empty list to store the extracted information
@@ -53,7 +122,7 @@ def extract_alternative_versions(soup):
 
 # Function to download the image and return its binary data
 def download_image(url):
-    response = requests.get(url)
+    response = http_client.get(url)
     return response.content
 
 def get_image(soup):
@@ -61,51 +130,106 @@ def get_image(soup):
   #image_data = download_image(image_url) # removed since i'll just store the urls
   return image_url
 
-def extract_info(soup, label):
-  div_elements = soup.select('.infoblurb div')
-  for div in div_elements:
+def label_pattern(label):
+  pattern = INFO_LABEL_PATTERNS.get(label)
+  if pattern is None:
+    pattern = INFO_LABEL_PATTERNS[label] = re.compile(rf'\b{label}\b', re.IGNORECASE)
+  return pattern
+
+def extract_infos(soup, labels):
+  # Reads the info block once for every label, the first matching div wins
+  infos = {}
+  for div in soup.select('.infoblurb div'):
     strong_element = div.find('strong')
-    if strong_element and re.search(rf'\b{label}\b', strong_element.text, re.IGNORECASE):
-      return div.text.split(':', 1)[-1].strip()
+    if not strong_element:
+      continue
+    strong_text = strong_element.text
+    for label in labels:
+      if label not in infos and label_pattern(label).search(strong_text):
+        infos[label] = div.text.split(':', 1)[-1].strip()
+  return infos
 
-def scrape_card_info(card_url, set_id):
-  response = requests.get(card_url)
-  if response.status_code == 200:
-    soup = BeautifulSoup(response.content, "html.parser")
+def extract_info(soup, label):
+  return extract_infos(soup, [label]).get(label)
 
-    h1_element = soup.find('h1', class_='icon set')
-    for child in h1_element.find_all():
-        child.extract()
-    card_name = h1_element.get_text(strip=True)
+def parse_card_page(content):
+  soup = make_soup(content, CARD_PAGE)
 
-    jpn_name = None
-    rarity = None
-    card_number = None
+  h1_element = soup.find('h1', class_='icon set')
+  for child in h1_element.find_all():
+      child.extract()
+  card_name = h1_element.get_text(strip=True)
 
-    # Extract the information for each label
-    jpn_name = extract_info(soup, 'JPN')
-    rarity = extract_info(soup, 'Rarity')
-    card_number = extract_info(soup, 'Card').split('/')[0]
+  # Extract the information for each label
+  infos = extract_infos(soup, INFO_LABELS)
+  jpn_name = infos.get('JPN')
+  rarity = infos.get('Rarity')
+  card_number = infos.get('Card').split('/')[0]
 
-    # extract the alternate versions
-    alt_versions = extract_alternative_versions(soup)
-    # extract the image
-    image_element = get_image(soup)
+  # extract the alternate versions
+  alt_versions = extract_alternative_versions(soup)
+  # extract the image
+  image_element = get_image(soup)
+  return card_name, jpn_name, rarity, card_number, alt_versions, image_element
+
+@timed('scrape_card_info')
+def scrape_card_info(card_url, set_id):
+  response = http_client.get(card_url)
+  if response.status_code == 200:
+    with timed('parse_card_page'):
+      card_name, jpn_name, rarity, card_number, alt_versions, image_element = parse_card_page(response.content)
 
-    image_response = requests.get(image_element)
-    image_data = image_response.content if image_response.status_code == 200 else None
     base_cards_path = f'{IMAGES_PATH}/{set_id}/cards'
     os.makedirs(base_cards_path, exist_ok=True)
     image_path = base_cards_path + f'/{card_number}.webp'
-    save_image_to_file(image_data, image_path)
+    if not is_image_current(image_element, image_path, IMAGE_SIZES):
+      image_response = http_client.get(image_element)
+      image_data = image_response.content if image_response.status_code == 200 else None
+      store_image(image_data, image_path, image_element, IMAGE_SIZES, set_id)
 
-    print('\tScraping card number: '+card_number)
+    METRICS.count('cards_scraped')
+    logger.info('Scraped card', extra={'set_id': set_id, 'number': card_number})
 
-    return {'card_name': card_name, 'jpn_name': jpn_name, 'rarity': rarity, 'number': card_number, 'alternate versions': alt_versions, 'image': image_element}
+    return {'card_name': card_name, 'jpn_name': jpn_name, 'rarity': rarity, 'number': card_number, 'alternate versions': alt_versions, 'image': image_element,
+            'image_paths': derivative_paths(image_path, IMAGE_SIZES), 'url': card_url}
   else:
-    print(f"Failed to retrieve data from {card_url}")
+    METRICS.count('failed_pages')
+    logger.error('Failed to retrieve card page', extra={'url': card_url, 'status': response.status_code})
     return {}
 
+def card_images_on_disk(card_info):
+  # Cards are journaled as soon as their scan is handed to the encoder, so a crash may leave a
+  # journaled card without its images
+  paths = card_info.get('image_paths')
+  return bool(paths) and all(os.path.exists(path) for path in paths.values())
+
+def iter_cards(card_urls, set_id, max_workers=8, journal=None):
+  # Card pages (and their images) are scraped by a pool of workers, the per-host rate limiter
+  # replaces the fixed sleep between cards. Cards are yielded in the order of card_urls, and at most
+  # 2 * max_workers of them are in flight so memory stays flat whatever the size of the set
+  def scrape_card(card_url):
+    if journal:
+      card_info = journal.get(card_url)
+      # Already scraped before the crawl was interrupted, and scraped again if its images were lost
+      if card_info is not None and card_images_on_disk(card_info):
+        return card_info
+    card_info = scrape_card_info(card_url, set_id)
+    if journal and card_info:
+      journal.record(card_url, card_info)
+    return card_info
+
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    in_flight = deque()
+    for card_url in card_urls:
+      in_flight.append(executor.submit(scrape_card, card_url))
+      if len(in_flight) >= 2 * max_workers:
+        yield in_flight.popleft().result()
+    while in_flight:
+      yield in_flight.popleft().result()
+
+def scrape_cards(card_urls, set_id, max_workers=8, journal=None):
+  return list(iter_cards(card_urls, set_id, max_workers, journal))
+
 def scrape_card_urls(set_url, soup):
     card_urls = []
 
@@ -116,9 +240,10 @@ def scrape_card_urls(set_url, soup):
     parsed_url = urlparse(set_url)
     base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
 
+    card_url_pattern = re.compile(re.escape(base_url) + CARD_URL_PATH_PATTERN)
     for anchor_tag in anchor_tags:
         card_url = urljoin(base_url, anchor_tag['href'])
-        if re.match(fr'{re.escape(base_url)}/.+Card-[a-zA-Z]*\d+[a-zA-Z]*$', card_url):
+        if card_url_pattern.match(card_url):
             card_urls.append(card_url)
     return card_urls
 
@@ -131,16 +256,27 @@ def scrape_icon_and_symbol_set(soup, id):
   os.makedirs(expansion_path, exist_ok=True)
   symbol_tag = soup.find('meta', {'property': 'og:image'})
   symbol_url = symbol_tag['content']
-  icon = download_media(icon_url)
-  symbol = download_media(symbol_url)
-
-  icon_path = expansion_path + '/icon.webp' if icon else None
-  symbol_path = expansion_path + '/symbol.webp' if symbol else None
-
-  if icon:
-    save_image_to_file(icon, icon_path)
-  if symbol:
-    save_image_to_file(symbol, symbol_path)
+  # The manifest lets populate_db find the images on disk instead of downloading them again
+  assets = AssetManifest(expansion_path)
+  icon_path = assets.local_path('icon')
+  symbol_path = assets.local_path('symbol')
+
+  # Flushed on their own group, without waiting for the cards of the set
+  group = (id, 'assets')
+  icon = symbol = None
+  if not is_image_current(icon_url, icon_path):
+    icon = download_media(icon_url)
+    if icon:
+      store_image(icon, icon_path, icon_url, group=group)
+  if not is_image_current(symbol_url, symbol_path):
+    symbol = download_media(symbol_url)
+    if symbol:
+      store_image(symbol, symbol_path, symbol_url, group=group)
+  # The loader may insert the expansion as soon as this returns, it must find both images on disk
+  flush_images(group)
+  assets.record('icon', icon_url, icon)
+  assets.record('symbol', symbol_url, symbol)
+  assets.save()
 
   return [symbol_url, icon_url]
 
@@ -171,67 +307,119 @@ def scrape_card_number(soup):
 
 def scrape_release_date(soup):
     #Find the span containing the release date month and day
-    pattern = re.compile(r'^(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) \d{1,2}(st|nd|rd|th)$')
-    release_date_span = soup.find('span', string=pattern)
+    release_date_span = soup.find('span', string=RELEASE_DATE_PATTERN)
 
     release_date = release_date_span.text.strip()
-    release_date = re.sub(r'(st|nd|rd|th)', '', release_date)
+    release_date = ORDINAL_SUFFIX_PATTERN.sub('', release_date)
     year = release_date_span.find_next('cite').text.strip()
     parsed_date = datetime.strptime(f"{release_date} {year}", "%b %d %Y")
     formatted_release_date = parsed_date.strftime("%Y-%m-%d")
     return formatted_release_date
 
+@timed('scrape_set')
 def scrape_set(set_url):
-  print("Scraping set: "+set_url)
-  response = requests.get(set_url)
+  logger.info('Scraping set', extra={'url': set_url})
+  response = http_client.get(set_url)
   if response.status_code == 200:
-    soup = BeautifulSoup(response.text, 'html.parser')
+    with timed('parse_set_page'):
+      soup = make_soup(response.text, SET_PAGE)
 
-    set_id, set_name = scrape_name_and_id(soup)
-    number_of_cards, number_of_secret_cards = scrape_card_number(soup)
-    formatted_release_date = scrape_release_date(soup)
+      set_id, set_name = scrape_name_and_id(soup)
+      number_of_cards, number_of_secret_cards = scrape_card_number(soup)
+      formatted_release_date = scrape_release_date(soup)
 
-    card_urls = scrape_card_urls(set_url, soup)
+      card_urls = scrape_card_urls(set_url, soup)
     icon_url, symbol_url = scrape_icon_and_symbol_set(soup, set_id)
 
+    METRICS.count('sets_scraped')
+    logger.info('Scraped set', extra={'set_id': set_id, 'cards': len(card_urls)})
     return set_id, set_name, number_of_cards, number_of_secret_cards, formatted_release_date, card_urls, icon_url, symbol_url
   else:
-    print(f"Failed to retrieve data from {set_url}")
+    METRICS.count('failed_pages')
+    logger.error('Failed to retrieve set page', extra={'url': set_url, 'status': response.status_code})
     return []
   
-def extract_set_urls(url):
-  response = requests.get(url)
+def extract_catalogue(url):
+  # (set url, generation) of every set listed at url, the generation is the heading the set is listed under
+  response = http_client.get(url)
   if response.status_code == 200:
-    soup = BeautifulSoup(response.text, 'html.parser')
-    set_urls = []
+    soup = make_soup(response.text, SET_LIST_PAGE)
+    catalogue = []
     # Find all anchor tags with class "button" and get their "href" attribute
     anchor_tags = soup.find_all('a', class_='button')
 
     for anchor_tag in anchor_tags:
-        set_url = anchor_tag['href']
-        set_urls.append(set_url)
+        heading = anchor_tag.find_previous('h1')
+        generation = heading.get_text(strip=True) if heading else None
+        catalogue.append((anchor_tag['href'], generation))
 
-    return set_urls
+    return catalogue
   else:
-    print(f"Failed to retrieve data from {url}")
+    METRICS.count('failed_pages')
+    logger.error('Failed to retrieve set list', extra={'url': url, 'status': response.status_code})
     return []
 
+def extract_set_urls(url):
+  return [set_url for set_url, generation in extract_catalogue(url)]
+
+# url is the card page, used by incremental updates to tell which cards are already scraped
+CARDS_CSV_HEADER = ['card_name', 'jpn_name', 'rarity', 'number', 'alternate versions', 'image', 'image_paths', 'url']
+
+def set_csv_path(save_path, set_id):
+  return os.path.join(save_path, 'sets', 'pokemon_cards_' + set_id + '.csv')
+
+def cards_csv_path(save_path, set_id):
+  return os.path.join(save_path, 'cards', 'pokemon_cards_' + set_id + '_cards.csv')
+
+def set_csv_header(is_jap):
+  return ['id', 'name', 'cards #', 'secret cards #', 'release date', 'icon_image', 'symbol_image', 'generation', 'italian_name' if not(is_jap) != 0 else '']
+
+def card_row(card):
+  # image_paths (size -> path) is written as JSON, cards read back from a CSV already have it as a string
+  image_paths = card.get('image_paths')
+  if isinstance(image_paths, dict):
+    image_paths = json.dumps(image_paths)
+  return [card['card_name'], card['jpn_name'], card['rarity'], card['number'], card['alternate versions'], card['image'], image_paths, card.get('url')]
+
+def write_set_csv(save_path, set_id, set_info, is_jap):
+  with open(set_csv_path(save_path, set_id), 'w', newline='', encoding='utf-8') as file:
+    writer = csv.writer(file)
+    writer.writerow(set_csv_header(is_jap))
+    writer.writerow(set_info)
+
+class CardsCsvWriter:
+  # Writes the cards CSV of a set one row at a time, so cards don't need to be buffered
+  def __init__(self, save_path, set_id):
+    self.path = cards_csv_path(save_path, set_id)
+    self.file = open(self.path, 'w', newline='', encoding='utf-8')
+    self.writer = csv.writer(self.file)
+    self.writer.writerow(CARDS_CSV_HEADER)
+
+  def write(self, card):
+    self.writer.writerow(card_row(card))
+
+  def close(self):
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
 def save_data(data, save_path, is_jap):
   # Specify the file name and extension
   for set_name, set_data in data.items():
-    csv_file_path_set = os.path.join(save_path, 'sets', 'pokemon_cards_' + set_name + '.csv')
-    csv_file_path_set_cards = os.path.join(save_path, 'cards', 'pokemon_cards_' + set_name + '_cards.csv')
     set_info = set_data['info']
     cards_info = set_data['cards']
 
-    with open(csv_file_path_set, 'w', newline='', encoding='utf-8') as file:
-      writer = csv.writer(file)
-      writer.writerow(['id', 'name', 'cards #', 'secret cards #', 'release date', 'icon_image', 'symbol_image', 'generation', 'italian_name' if not(is_jap) != 0 else '']) 
-      writer.writerow(set_info)
+    write_set_csv(save_path, set_name, set_info, is_jap)
 
-    with open(csv_file_path_set_cards, 'w', newline='', encoding='utf-8') as file:
-      writer = csv.writer(file)
-      writer.writerow(['card_name', 'jpn_name', 'rarity', 'number', 'alternate versions', 'image'])
+    with CardsCsvWriter(save_path, set_name) as writer:
       for card in cards_info:
-          writer.writerow([card['card_name'], card['jpn_name'], card['rarity'], card['number'], card['alternate versions'], card['image']])
+          writer.write(card)
+    export_columnar(set_info, cards_info, is_jap)
+    index_cards(set_info, cards_info, is_jap)
 
+    # The set is only complete once its images are on disk
+    flush_images(set_name)
@@ -1,17 +1,26 @@
 import shutil
 from io import BytesIO
-from PIL import Image
 import base64
-import pandas as pd
-import requests
 from datetime import datetime
 import os
-import psycopg2
-import csv
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import execute_values, Json
+
+from lookup_cache import get_lookup_cache, commit
+from csv_rows import read_set_rows, read_card_rows, is_missing
+from assets import AssetManifest
+from metrics import METRICS, timed
 
 ENGLISH_EXCLUSIVE_EXPANSIONS = {'B2', 'BEST', 'BOO', 'BOO24', 'DCR', 'FUT20', 'GC', 'GH', 'LC', 'LTR', 'LTR_RC', 'MCD14', 'PK', 'RM', 'SI', 'SV', 'SV_SH', 'TRR'}
 FRENCH_EXCLUSIVE_EXPANSIONS = {'MCD19F'}
 EU_LANGUAGES = ['ITA', 'ENG', 'FRE', 'SPA', 'GER']
+JAP_LANGUAGES = ['JAP']
+DEFAULT_SYMBOL_IMAGE_URL = 'https://static.tcgcollector.com/build/images/default-expansion-logo-500x256.ef41d58e.png'
+IMAGES_PATH = './expansion_images' # root of the set and card images, the same one the scraper saved them in
+
+logger = logging.getLogger(__name__)
 
 def move_file(source_path, destination_folder):
     # Create the destination folder if it doesn't exist
@@ -23,22 +32,34 @@ def move_file(source_path, destination_folder):
     # Move the file
     shutil.move(source_path, destination_path)
 
+# Statements used to add values missing from the lookup tables, see insert_lookup_values. Sets are
+# loaded on several connections at once, so two of them may add the same value: the conflict on the
+# unique key (CardType references illustrators by name) skips it instead of failing the set
+LOOKUP_INSERTS = {
+  'version': 'INSERT INTO AlternateVersion (version) VALUES %s ON CONFLICT DO NOTHING',
+  'rarity': 'INSERT INTO Rarity (name) VALUES %s ON CONFLICT DO NOTHING',
+  'illustrator': 'INSERT INTO Illustrator (name) VALUES %s ON CONFLICT DO NOTHING',
+}
+
+def insert_lookup_values(cursor, kind, values):
+  # Only the values the lookup cache has never seen reach the database
+  cache = get_lookup_cache(cursor)
+  missing = cache.missing(cursor.connection, kind, values)
+  if missing:
+    execute_values(cursor, LOOKUP_INSERTS[kind], [(value,) for value in missing])
+    cache.added(cursor.connection, kind, missing)
+
 def get_or_insert_illustrator(curr, illustrator):
-  illustrator_id = None
-  if not illustrator or pd.isna(illustrator):
+  if not illustrator or is_missing(illustrator):
     return None
-  curr.execute("SELECT name FROM Illustrator WHERE name = %s", (illustrator,)) # check if it exists
-  illustrator_id = curr.fetchone()
-
-  if illustrator_id is None:
-    curr.execute("INSERT INTO illustrator (name) VALUES (%s) RETURNING name", (illustrator,)) # insert if it doesn't exist
-    illustrator_id = curr.fetchone()[0]
-  print(f'\tCard\'s illustrator: {illustrator}')
-  return illustrator_id
+  insert_lookup_values(curr, 'illustrator', [illustrator])
+  logger.debug('Illustrator', extra={'illustrator': illustrator})
+  return illustrator
 
 def download_media(url):
-  if pd.isna(url): return None
-  response = requests.get(url)
+  import http_client # requests is only loaded by the loads that download, not by the database-only commands
+  if is_missing(url): return None
+  response = http_client.get(url)
   return BytesIO(response.content)
 
 
@@ -59,23 +80,8 @@ def get_super_expansion(filename):
     else:
         return None
 
-def save_image_to_file(image_data, file_path, format='WEBP'):
-    # Convert image_data to a BytesIO object if it's not already one
-    if not isinstance(image_data, BytesIO):
-        image_data = BytesIO(image_data)
-
-    # Open the image using PIL
-    image = Image.open(image_data)
-
-    # Convert the image to WebP format
-    image_webp_data = BytesIO()
-    image.save(image_webp_data, format=format)
-
-    # Save the WebP image data to the file
-    with open(file_path, 'wb') as file:
-        file.write(image_webp_data.getvalue())
-
 def create_sets_dictionary(file_path):
+    import pandas as pd # only needed to read the spreadsheet, keeps pandas and openpyxl out of the module import
     sets_dict = {}
     df = pd.read_excel(file_path)
     for index, row in df.iterrows():
@@ -90,282 +96,456 @@ def create_sets_dictionary(file_path):
 
 # Cards population
 
-def populate_cardtype(conn, cursor, expansion, cards_path, save_image_path):
-  df = pd.read_csv(cards_path, sep=',', encoding='latin1')
+def parse_alt_versions(alt_versions):
+  # Cards read back from the CSV store the list as its string representation
+  if isinstance(alt_versions, str):
+    alt_versions = [version.strip().strip("'") for version in alt_versions.strip('[]').split(',')]
+  alt_versions_list = list(alt_versions)
+  alt_versions_list.append('default')
+  return alt_versions_list
+
+def parse_image_sizes(image_paths):
+  # Sizes the scraper wrote for a card (see image_pipeline.CARD_IMAGE_SIZES), None for cards scraped
+  # before the derivatives. Cards read back from the CSV store the paths as JSON
+  if not image_paths or is_missing(image_paths):
+    return None
+  if isinstance(image_paths, str):
+    image_paths = json.loads(image_paths)
+  return list(image_paths)
+
+def card_image_paths(image_path, image_sizes):
+  # CardType.image_paths (jsonb): size -> path of every derivative of the card scan, the paths
+  # follow image_path like the scraper's follow its own
+  if not image_sizes:
+    return None
+  from image_pipeline import derivative_paths # keeps PIL out of the module import
+  return Json(derivative_paths(image_path, image_sizes))
+
+def insert_card(cursor, expansion, number, card_name, rarity, illustrator, alt_versions, image_sizes=None, images_path=IMAGES_PATH):
+  logger.debug('Inserting card', extra={'expansion': expansion, 'number': number})
+
+  # Populate AlternateVersion table
+  alt_versions_list = parse_alt_versions(alt_versions)
+  insert_lookup_values(cursor, 'version', [version for version in alt_versions_list if version])
+
+  # Populate Rarity table
+  insert_lookup_values(cursor, 'rarity', [rarity])
+
+  # Download and store the image # not needed, downloaded in pokellector_scraper
+  # image_response = requests.get(image_url)
+  # image_data = image_response.content if image_response.status_code == 200 else None
+
+  base_cards_path = f'{images_path}/{expansion}/cards'
+  os.makedirs(base_cards_path, exist_ok=True)
+  image_path = base_cards_path + f'/{number}.webp'
+  #save_image_to_file(image_data, image_path)
+  image_paths = card_image_paths(image_path, image_sizes)
+
+  # Populate CardType table
+  if illustrator and not is_missing(illustrator):
+    get_or_insert_illustrator(cursor, illustrator)
+    cursor.execute('''
+        INSERT INTO CardType (number, expansion, illustrator, name, rarity, image_path, image_paths)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ''', (number, expansion, illustrator, card_name, rarity, image_path, image_paths))
+  else:
+    cursor.execute('''
+        INSERT INTO CardType (number, expansion, name, rarity, image_path, image_paths)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    ''', (number, expansion, card_name, rarity, image_path, image_paths))
+  for version in alt_versions_list:
+    if version:
+      # Associate each card to a list of possible versioncardtype
+      cursor.execute('INSERT INTO versionCardType (version, card_number, card_expansion) VALUES (%s, %s, %s)', (version, number, expansion))
+  METRICS.count('cards_inserted')
+  logger.info('Added card', extra={'expansion': expansion, 'number': number, 'card_name': card_name})
+
+# With upsert=True cards already in CardType are updated, and only if one of their values changed
+CARD_UPSERT = '''
+    ON CONFLICT (number, expansion) DO UPDATE SET
+        illustrator = EXCLUDED.illustrator, name = EXCLUDED.name, rarity = EXCLUDED.rarity, image_path = EXCLUDED.image_path,
+        image_paths = EXCLUDED.image_paths
+    WHERE (CardType.illustrator, CardType.name, CardType.rarity, CardType.image_path, CardType.image_paths)
+        IS DISTINCT FROM (EXCLUDED.illustrator, EXCLUDED.name, EXCLUDED.rarity, EXCLUDED.image_path, EXCLUDED.image_paths)
+'''
+
+def card_values(expansion, cards, images_path=IMAGES_PATH):
+  # cards is a list of (number, card_name, rarity, illustrator, alt_versions, image_sizes) tuples.
+  # Returns the CardType rows, the versionCardType rows and the rarities, versions and illustrators
+  # they reference, deduplicated in memory. Image paths are under images_path
+  rarities = {}
+  versions = {}
+  illustrators = {}
+  card_rows = []
+  version_rows = []
+  base_cards_path = f'{images_path}/{expansion}/cards'
+  for number, card_name, rarity, illustrator, alt_versions, image_sizes in cards:
+    if not illustrator or is_missing(illustrator):
+      illustrator = None
+    else:
+      illustrators[illustrator] = None
+    rarities[rarity] = None
+    card_versions = list(dict.fromkeys(version for version in parse_alt_versions(alt_versions) if version))
+    for version in card_versions:
+      versions[version] = None
+      version_rows.append((version, number, expansion))
+    image_path = base_cards_path + f'/{number}.webp'
+    card_rows.append((number, expansion, illustrator, card_name, rarity, image_path, card_image_paths(image_path, image_sizes)))
+  return card_rows, version_rows, rarities, versions, illustrators
+
+def bulk_insert_cards(cursor, expansion, cards, upsert=False, images_path=IMAGES_PATH):
+  # Every table is written with a single execute_values statement instead of a few round trips per card
+  os.makedirs(f'{images_path}/{expansion}/cards', exist_ok=True)
+  card_rows, version_rows, rarities, versions, illustrators = card_values(expansion, cards, images_path)
+  if not card_rows:
+    return
+
+  insert_lookup_values(cursor, 'version', versions)
+  insert_lookup_values(cursor, 'rarity', rarities)
+  insert_lookup_values(cursor, 'illustrator', illustrators)
+  execute_values(cursor, '''
+      INSERT INTO CardType (number, expansion, illustrator, name, rarity, image_path, image_paths)
+      VALUES %s
+  ''' + (CARD_UPSERT if upsert else ''), card_rows, page_size=len(card_rows))
+  # A single page, so the rowcount has every row inserted or updated, unchanged rows are not counted
+  written = cursor.rowcount if upsert else len(card_rows)
+  execute_values(cursor, 'INSERT INTO versionCardType (version, card_number, card_expansion) VALUES %s' + (' ON CONFLICT DO NOTHING' if upsert else ''),
+                 version_rows, page_size=max(1, len(version_rows)))
+  METRICS.count('cards_upserted' if upsert else 'cards_inserted', written)
+  logger.info('Added cards', extra={'expansion': expansion, 'cards': written, 'unchanged': len(card_rows) - written})
+
+@timed('populate_cardtype')
+def populate_cardtype(conn, cursor, expansion, cards_path, save_image_path, bulk=False, upsert=False, images_path=IMAGES_PATH):
+  bulk = bulk or upsert # upserts only go through bulk_insert_cards
   unnumbered_index = 1
-  for index, row in df.iterrows():
-    card_name = row['card_name']
-    rarity = row['rarity']
-    if pd.isna(row['number']):
-      row['number'] = 'unnumbered_'+str(unnumbered_index)
+  cards = []
+  for row in read_card_rows(cards_path):
+    number = row.number
+    if number is None:
+      number = 'unnumbered_'+str(unnumbered_index)
       unnumbered_index += 1
-    number = row['number']
-    illustrator = row.get('illustrator', None) # returns None if the column illustrator does not exist
-    alt_versions = row['alternate versions']
-    image_url = row['image']
-    print(f'\tInserting card {number}')
-
-    # Populate AlternateVersion table
-    alt_versions_list = [version.strip().strip("'") for version in alt_versions.strip('[]').split(',')]
-    alt_versions_list.append('default')
-    for version in alt_versions_list:
-      if version:
-
-        cursor.execute('INSERT INTO AlternateVersion (version) VALUES (%s) ON CONFLICT DO NOTHING', (version,))
-
-    # Populate Rarity table
-    cursor.execute('INSERT INTO Rarity (name) VALUES (%s) ON CONFLICT DO NOTHING', (rarity,))
-
-    # Download and store the image # not needed, downloaded in pokellector_scraper
-  #  image_response = requests.get(image_url)
-   # image_data = image_response.content if image_response.status_code == 200 else None
-
-    base_cards_path = f'./expansion_images/{expansion}/cards'
-    os.makedirs(base_cards_path, exist_ok=True)
-    image_path = base_cards_path + f'/{number}.webp'
-    #save_image_to_file(image_data, image_path)
-
-    # Populate CardType table
-    if illustrator and pd.notna(illustrator):
-      print(f"Inserting new illustrator {illustrator}")
-      get_or_insert_illustrator(cursor, illustrator)
-      cursor.execute('''
-          INSERT INTO CardType (number, expansion, illustrator, name, rarity, image_path)
-          VALUES (%s, %s, %s, %s, %s, %s)
-      ''', (number, expansion, illustrator, card_name, rarity, image_path))
+    # row.illustrator is None if the column illustrator does not exist
+    if bulk:
+      cards.append((number, row.card_name, row.rarity, row.illustrator, row.alternate_versions, parse_image_sizes(row.image_paths)))
     else:
-      cursor.execute('''
-          INSERT INTO CardType (number, expansion, name, rarity, image_path)
-          VALUES (%s, %s, %s, %s, %s)
-      ''', (number, expansion, card_name, rarity, image_path))
-    for version in alt_versions_list:
-      if version:
-        # Associate each card to a list of possible versioncardtype
-        cursor.execute('INSERT INTO versionCardType (version, card_number, card_expansion) VALUES (%s, %s, %s)', (version, number, expansion))
-    print(f'\tAdded a new card: {card_name}')
-  conn.commit()
+      insert_card(cursor, expansion, number, row.card_name, row.rarity, row.illustrator, row.alternate_versions, parse_image_sizes(row.image_paths),
+                  images_path)
+  if bulk:
+    bulk_insert_cards(cursor, expansion, cards, upsert, images_path)
+  commit(conn)
   new_cards_path = os.path.join(os.path.dirname(cards_path), 'processed cards')
   move_file(cards_path, new_cards_path)
 
-def populate_table_from_csv(conn, cursor, set_path, cards_path, is_jap, sets_dict, default_symbol_image_url='https://static.tcgcollector.com/build/images/default-expansion-logo-500x256.ef41d58e.png'):
-    df = pd.read_csv(set_path, delimiter=',', encoding='latin1')
+# With upsert=True an expansion that is already stored is updated instead of failing the insert
+EXPANSION_UPSERT = '''
+    ON CONFLICT (id) DO UPDATE SET
+        name = EXCLUDED.name, release_date = EXCLUDED.release_date, main_set_number = EXCLUDED.main_set_number, generation = EXCLUDED.generation,
+        super_expansion = EXCLUDED.super_expansion, icon_path = EXCLUDED.icon_path, symbol_path = EXCLUDED.symbol_path
+    WHERE (CardExpansion.name, CardExpansion.release_date, CardExpansion.main_set_number, CardExpansion.generation,
+           CardExpansion.super_expansion, CardExpansion.icon_path, CardExpansion.symbol_path)
+        IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.release_date, EXCLUDED.main_set_number, EXCLUDED.generation,
+           EXCLUDED.super_expansion, EXCLUDED.icon_path, EXCLUDED.symbol_path)
+'''
+WORLD_EXPANSION_UPSERT = '''
+    ON CONFLICT (id) DO UPDATE SET italian_name = EXCLUDED.italian_name
+    WHERE CardExpansionWorld.italian_name IS DISTINCT FROM EXCLUDED.italian_name
+'''
+
+def expansion_values(row, is_jap, sets_dict, super_expansion, source, default_symbol_image_url=DEFAULT_SYMBOL_IMAGE_URL, offline=False,
+                     images_path=IMAGES_PATH):
+    # (CardExpansion row, CardExpansionWorld or CardExpansionJap row, expansion_path) of a set row,
+    # None if it can't be inserted. offline only uses the images already on disk
+    if not(is_jap):
+      if row.name == '151':
+        italian_name = '151'
+      elif row.name.startswith("McDonald's Collection"):
+        italian_name = row.name
+      else:
+        parts = row.name.split('-')
+        if len(parts)==2:
+          s,sub = row.name.split('-')[0].strip(), row.name.split('-')[1].strip()
+          italian_name = sets_dict[s] + ' - ' + sub
+        else:
+            italian_name = row.italian_name
+            if is_missing(italian_name):
+              try:
+                italian_name = sets_dict[row.italiano]
+                if is_missing(italian_name):
+                  italian_name = row.name
+              except (KeyError, TypeError):
+                italian_name = row.name
+    id = row.id
+    name = row.name
+    release_date = row.release_date
+    main_card_number = row.cards
+    generation = row.generation or '' # sets found by the catalogue crawl may not have one
+    if generation.endswith(' Series'):
+        generation = generation.replace(' Series', '')
+    elif generation.endswith(' Era'):
+        generation = generation.replace(' Era', '')
+    if generation == 'Black & Whit':
+      generation = 'Black & White' # idk why
+    icon_url = row.icon_image
+    symbol_url = row.symbol_image if not is_missing(row.symbol_image) else default_symbol_image_url
+
+    release_date = convert_date_format(release_date)  # Convert date format
+
+    if release_date is None:
+        logger.error('Invalid date format', extra={'release_date': row.release_date, 'source': source})
+        return None
+
+    expansion_path = f'{images_path}/{id}'
+
+    # The image download logic is handled by the scraper: the icon and the symbol are only
+    # downloaded (and saved) here if they are not on disk
+    assets = AssetManifest(expansion_path)
+    if offline:
+      icon_path = assets.resolve('icon', icon_url, lambda url: None)
+      symbol_path = assets.resolve('symbol', symbol_url, lambda url: None)
+    else:
+      os.makedirs(expansion_path, exist_ok=True)
+      icon_path = assets.resolve('icon', icon_url, download_media)
+      symbol_path = assets.resolve('symbol', symbol_url, download_media)
+      assets.save()
+
+    expansion = (id, name, release_date, main_card_number, generation, super_expansion, icon_path, symbol_path)
+    return expansion, ((id,) if is_jap else (id, italian_name)), expansion_path
+
+def insert_expansion(cursor, row, is_jap, sets_dict, super_expansion, source, default_symbol_image_url=DEFAULT_SYMBOL_IMAGE_URL, upsert=False,
+                     images_path=IMAGES_PATH):
+    logger.info('Inserting expansion', extra={'expansion_name': row.name, 'source': source})
+    values = expansion_values(row, is_jap, sets_dict, super_expansion, source, default_symbol_image_url, images_path=images_path)
+    if values is None:
+        return None
+    expansion, localized_expansion, expansion_path = values
+
+    #CHECK IF THE MAIN_CARD_NUMBER IS ACTUALLY INSERTED!
+    cursor.execute(
+        "INSERT INTO CardExpansion (id, name, release_date, main_set_number, generation, super_expansion, icon_path, symbol_path) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
+        + (EXPANSION_UPSERT if upsert else ''),
+        expansion
+    )
+    if not(is_jap):
+      cursor.execute(
+          "INSERT INTO CardExpansionWorld (id, italian_name) VALUES (%s, %s)" + (WORLD_EXPANSION_UPSERT if upsert else ''), localized_expansion
+      )
+    else:
+      cursor.execute(
+          "INSERT INTO CardExpansionJap (id) VALUES (%s)" + (" ON CONFLICT DO NOTHING" if upsert else ''), localized_expansion
+      )
+    METRICS.count('expansions_inserted')
+    logger.info('Added expansion', extra={'expansion': expansion[0], 'expansion_name': row.name})
+    return expansion_path
+
+@timed('populate_table_from_csv')
+def populate_table_from_csv(conn, cursor, set_path, cards_path, is_jap, sets_dict, default_symbol_image_url=DEFAULT_SYMBOL_IMAGE_URL, bulk=False, set_rows=None, upsert=False,
+                            images_path=IMAGES_PATH):
+    if set_rows is None:
+        set_rows = read_set_rows(set_path)
 
     super_expansion = get_super_expansion(os.path.basename(set_path))
-    for index, row in df.iterrows():
-        print('Inserting '+ str(row['name'])+' from '+set_path)
-        if not(is_jap):
-          if row['name'] == 151:
-            italian_name = 151
-          elif row['name'].startswith("McDonald's Collection"):
-            italian_name = row['name']
-          else:
-            parts = row['name'].split('-')
-            if len(parts)==2:
-              s,sub = row['name'].split('-')[0].strip(), row['name'].split('-')[1].strip()
-              italian_name = sets_dict[s] + ' - ' + sub
-            else:
-                italian_name = row['italian_name']
-                if pd.isna(italian_name):
-                  try:
-                    italian_name = sets_dict[row['Italiano']]
-                    if pd.isna(italian_name):
-                      italian_name = row['name']
-                  except KeyError:
-                    italian_name = row['name']
-        id = row['id']
-        name = row['name']
-        release_date = row['release date']
-        main_card_number = row['cards #']
-        generation = row['generation']
-        if generation.endswith(' Series'):
-            generation = generation.replace(' Series', '')
-        elif generation.endswith(' Era'):
-            generation = generation.replace(' Era', '')
-        if generation == 'Black & Whit':
-          generation = 'Black & White' # idk why
-        icon_url = row['icon_image']
-        symbol_url = row['symbol_image'] if pd.notna(row['symbol_image']) else default_symbol_image_url
-
-        release_date = convert_date_format(release_date)  # Convert date format
-
-        if release_date is None:
-            print(f"Invalid date format: {row['release date']} in CSV: {set_path}")
+    for row in set_rows:
+        expansion_path = insert_expansion(cursor, row, is_jap, sets_dict, super_expansion, set_path, default_symbol_image_url, upsert, images_path)
+        if expansion_path is None:
             continue
 
-        icon = download_media(icon_url)
-        symbol = download_media(symbol_url)
-
-        expansion_path = f'./expansion_images/{id}'
-        os.makedirs(expansion_path, exist_ok=True)
-
-        icon_path = expansion_path + '/icon.webp' if icon else None
-        symbol_path = expansion_path + '/symbol.webp' if symbol else None
-
-        ### now the image download logic is handled by the scraper
-        # if icon:
-        #   save_image_to_file(icon, icon_path)
-        # if symbol:
-        #   save_image_to_file(symbol, symbol_path)
-
-        #CHECK IF THE MAIN_CARD_NUMBER IS ACTUALLY INSERTED!
-        cursor.execute(
-            "INSERT INTO CardExpansion (id, name, release_date, main_set_number, generation, super_expansion, icon_path, symbol_path) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-            (id, name, release_date, main_card_number, generation, super_expansion, icon_path, symbol_path)
-        )
-        if not(is_jap):
-          cursor.execute(
-              "INSERT INTO CardExpansionWorld (id, italian_name) VALUES (%s, %s)", (id, italian_name)
-          )
-        else:
-          cursor.execute(
-              "INSERT INTO CardExpansionJap (id) VALUES (%s)", (id,)
-          )
-        print(f"Added {row['name']}!")
-
-        populate_cardtype(conn, cursor, row['id'], cards_path, expansion_path)
+        populate_cardtype(conn, cursor, row.id, cards_path, expansion_path, bulk, upsert, images_path)
 
         # Move the set to the 'processed' subfolder
         new_set_path = os.path.join(os.path.dirname(set_path), 'processed sets')
         move_file(set_path, new_set_path)
 
-        conn.commit()
+        commit(conn)
 
 def get_release_date(entry):
     return entry[4]  # Index 4 corresponds to the 'release date' attribute in my CSV format
 
-def populate_expansion_table(db_params, sets_path, all_sets_cards_path, is_jap, all_sets_path=None):
-    print('### START POPULATING! ###')
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(**db_params)
-    cursor = conn.cursor()
-
+def populate_expansion_table(db, sets_path, all_sets_cards_path, is_jap, all_sets_path=None, bulk=False, upsert=False, images_path=IMAGES_PATH):
+    # upsert=True reloads sets that are already stored, e.g. the CSVs of an incremental update.
+    # images_path is the folder the scraper saved the images in
+    logger.info('Start populating', extra={'sets_path': sets_path})
     sets_dict = create_sets_dictionary(all_sets_path) if all_sets_path else None
+    sorted_file_details = collect_set_files(sets_path)
+
+    # Check a connection out of the pool for the whole load
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        for file_detail in sorted_file_details:
+            filename = file_detail['filename']
+            set_path = os.path.join(sets_path, filename)
+            cards_path = os.path.join(all_sets_cards_path, filename.split('.')[0]+'_cards.csv')
+            populate_table_from_csv(conn, cursor, set_path, cards_path, is_jap, sets_dict, bulk=bulk, set_rows=file_detail['rows'], upsert=upsert,
+                                    images_path=images_path)
+        cursor.close()
+    logger.info('Expansion table populated', extra={'sets': len(sorted_file_details)})
 
+def collect_set_files(sets_path):
     # List to store file details
     file_details = []
 
-    # Collect file details from each .csv file
+    # Collect file details from each .csv file, the parsed rows are kept so each file is read once
     for filename in sorted(os.listdir(sets_path)):
         if filename.endswith('.csv'):
             set_path = os.path.join(sets_path, filename)
-            with open(set_path, 'r') as csv_file:
-                csv_reader = csv.DictReader(csv_file, delimiter=',')
-                for row in csv_reader:
-                    file_details.append({
-                        'filename': filename,
-                        'release_date': convert_date_format(row['release date']),
-                        'name': row['name']
-                    })
+            set_rows = read_set_rows(set_path)
+            if set_rows:
+                file_details.append({
+                    'filename': filename,
+                    'release_date': convert_date_format(set_rows[0].release_date),
+                    'name': set_rows[0].name,
+                    'rows': set_rows
+                })
 
     # Sort the file details by release_date and then by name
-    sorted_file_details = sorted(file_details, key=lambda x: (x['release_date'], x['name']))
+    return sorted(file_details, key=lambda x: (x['release_date'], x['name']))
 
-    for file_detail in sorted_file_details:
-        filename = file_detail['filename']
-        set_path = os.path.join(sets_path, filename)
-        df = pd.read_csv(set_path, encoding='latin1')
-        cards_path = os.path.join(all_sets_cards_path, filename.split('.')[0]+'_cards.csv')
-        populate_table_from_csv(conn, cursor, set_path, cards_path, is_jap, sets_dict)
+# Parallel loading
 
-    # Close the database connection
+def card_tuples(card_rows):
+  # (number, card_name, rarity, illustrator, alt_versions, image_sizes) tuples of CardRows, numbered as in populate_cardtype
+  unnumbered_index = 1
+  cards = []
+  for row in card_rows:
+    number = row.number
+    if number is None:
+      number = 'unnumbered_'+str(unnumbered_index)
+      unnumbered_index += 1
+    cards.append((number, row.card_name, row.rarity, row.illustrator, row.alternate_versions, parse_image_sizes(row.image_paths)))
+  return cards
+
+def insert_card_lookups(cursor, cards):
+  # Versions, rarities and illustrators of every card, so the expansions loaded in parallel only
+  # find them in the lookup cache and never race each other to insert the same value
+  versions = {}
+  rarities = {}
+  illustrators = {}
+  for number, card_name, rarity, illustrator, alt_versions, image_sizes in cards:
+    if illustrator and not is_missing(illustrator):
+      illustrators[illustrator] = None
+    rarities[rarity] = None
+    for version in parse_alt_versions(alt_versions):
+      if version:
+        versions[version] = None
+  insert_lookup_values(cursor, 'version', versions)
+  insert_lookup_values(cursor, 'rarity', rarities)
+  insert_lookup_values(cursor, 'illustrator', illustrators)
+
+def commit_card_lookups(cursor, cards):
+  # The lookup values of cards committed in a short transaction of their own, on a connection that is
+  # not the one inserting the cards. A transaction left open for a whole set (see pipeline.DatabaseSink)
+  # then never holds the rows of a new value the other sets wait for, and bulk_insert_cards only
+  # finds them in the lookup cache
+  if not cards:
+    return
+  insert_card_lookups(cursor, cards)
+  commit(cursor.connection)
+
+@timed('load_expansion_cards')
+def load_expansion_cards(db, expansion, cards, set_path, cards_path, upsert=False, images_path=IMAGES_PATH):
+  # One transaction per expansion on its own pooled connection
+  with db.connection() as conn:
+    cursor = conn.cursor()
+    bulk_insert_cards(cursor, expansion, cards, upsert, images_path)
+    commit(conn)
     cursor.close()
-    conn.close()
-    print("Expansion table populated successfully!")
-
-def get_japexpansions(db_params):
-  conn = psycopg2.connect(**db_params)
-  cursor = conn.cursor()
-  try:
-    # Execute a SELECT query to fetch the cardexpansionjap.id values
-    cursor.execute("""
-        SELECT id
-        FROM cardexpansionjap
-        WHERE NOT EXISTS (
-          SELECT 1
-          FROM allowedexpansionlanguage
-          WHERE allowedexpansionlanguage.expansion = cardexpansionjap.id
-        )
-    """)
-    # Fetch all the results
-    rows = cursor.fetchall()
-    # Extract the ids and put them in a list
-    id_list = [row[0] for row in rows]
-
-    return id_list
-  except Exception as e:
-    print(f"Error: {e}")
-
-def get_worldexpansions(db_params):
-  conn = psycopg2.connect(**db_params)
-  cursor = conn.cursor()
-  try:
-    # Execute a SELECT query to fetch the cardexpansionworld.id values
-    cursor.execute("""
-      SELECT id
-      FROM cardexpansionworld
-      WHERE NOT EXISTS (
-          SELECT 1
-          FROM allowedexpansionlanguage
-          WHERE allowedexpansionlanguage.expansion = cardexpansionworld.id
-        )
-    """)
-    # Fetch all the results
-    rows = cursor.fetchall()
-    # Extract the ids and put them in a list
-    id_list = [row[0] for row in rows]
-
-    return id_list
-  except Exception as e:
-    print(f"Error: {e}")
-
-def insert_allowedexpansionlanguage(db_params, expansions_list, languages):
-  conn = psycopg2.connect(**db_params)
-  cursor = conn.cursor()
-  try:
-    for expansion_id in expansions_list:
-      for language_id in languages:
-        # Execute an INSERT query to insert into allowedexpansionlanguage table
-        cursor.execute(
-            "INSERT INTO allowedexpansionlanguage (expansion, language) VALUES (%s, %s)",
-            (expansion_id, language_id)
-        )
-
-    # Commit the changes to the database
-    conn.commit()
-
-  except Exception as e:
-    # Rollback the transaction in case of an error
-    conn.rollback()
-    print(f"Error: {e}")
-
-def get_expansions_missing_language(db_params):
-    worldexpansions = get_worldexpansions(db_params)
-
-   # Print the results
-    missing_english_expansions = [expansion for expansion in ENGLISH_EXCLUSIVE_EXPANSIONS if expansion not in worldexpansions]
-   # print("Missing English expansions:", missing_english_expansions)
-    missing_french_expansions = [expansion for expansion in FRENCH_EXCLUSIVE_EXPANSIONS if expansion not in worldexpansions]
-   # print("Missing French expansions:", missing_french_expansions)
-
-    non_exclusive_language_expansions = worldexpansions.copy()
-
-    for expansion in ENGLISH_EXCLUSIVE_EXPANSIONS:
-        if expansion in non_exclusive_language_expansions:
-            print('removed '+expansion)
-            non_exclusive_language_expansions.remove(expansion)
-
-    for expansion in FRENCH_EXCLUSIVE_EXPANSIONS:
-        if expansion in non_exclusive_language_expansions:
-            print('removed '+expansion)
-            non_exclusive_language_expansions.remove(expansion)
-
-    return non_exclusive_language_expansions
-
-def insert_eu_languages(db_params):
-    non_exclusive_language_expansions = get_expansions_missing_language(db_params)
-    insert_allowedexpansionlanguage(db_params, non_exclusive_language_expansions, EU_LANGUAGES)
-
-def insert_jp_language(db_params):
-   jap_expansions = get_japexpansions(db_params)
-   insert_allowedexpansionlanguage(db_params, jap_expansions, ['JAP'])
-    
\ No newline at end of file
+  move_file(cards_path, os.path.join(os.path.dirname(cards_path), 'processed cards'))
+  move_file(set_path, os.path.join(os.path.dirname(set_path), 'processed sets'))
+
+@timed('populate_expansion_table_parallel')
+def populate_expansion_table_parallel(db, sets_path, all_sets_cards_path, is_jap, all_sets_path=None, workers=4, upsert=False, images_path=IMAGES_PATH):
+    # Same result as populate_expansion_table(bulk=True), in two phases:
+    #   1. on one connection, every expansion in release order and every lookup value its cards need
+    #   2. the cards of each expansion on `workers` pooled connections, one transaction per expansion
+    # db needs at least `workers` connections. The expansions of phase 1 are committed, so if phase 2
+    # fails for some of them their CSVs stay in place and can be loaded again with upsert=True
+    logger.info('Start populating in parallel', extra={'sets_path': sets_path, 'workers': workers})
+    sets_dict = create_sets_dictionary(all_sets_path) if all_sets_path else None
+
+    loads = []
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        for file_detail in collect_set_files(sets_path):
+            filename = file_detail['filename']
+            set_path = os.path.join(sets_path, filename)
+            cards_path = os.path.join(all_sets_cards_path, filename.split('.')[0]+'_cards.csv')
+            super_expansion = get_super_expansion(filename)
+            for row in file_detail['rows']:
+                if insert_expansion(cursor, row, is_jap, sets_dict, super_expansion, set_path, upsert=upsert, images_path=images_path) is None:
+                    continue
+                cards = card_tuples(read_card_rows(cards_path))
+                insert_card_lookups(cursor, cards)
+                loads.append((row.id, cards, set_path, cards_path))
+        commit(conn)
+        cursor.close()
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(load_expansion_cards, db, expansion, cards, set_path, cards_path, upsert, images_path): expansion
+                   for expansion, cards, set_path, cards_path in loads}
+        for future, expansion in futures.items():
+            if future.exception() is not None:
+                failed.append(expansion)
+                logger.error('Could not load the cards of an expansion', exc_info=future.exception(), extra={'expansion': expansion})
+    logger.info('Expansion table populated', extra={'sets': len(loads) - len(failed), 'failed': len(failed)})
+    if failed:
+        raise RuntimeError(f'Cards not loaded for {len(failed)} expansions: {", ".join(failed)}')
+
+# Languages of the expansions listed here replace the default ones, e.g. sets only printed in English
+LANGUAGE_OVERRIDES = {
+  **{expansion: ['ENG'] for expansion in ENGLISH_EXCLUSIVE_EXPANSIONS},
+  **{expansion: ['FRE'] for expansion in FRENCH_EXCLUSIVE_EXPANSIONS},
+}
+
+def expansion_languages(expansion, is_jap, world_languages=EU_LANGUAGES, jap_languages=JAP_LANGUAGES, overrides=LANGUAGE_OVERRIDES):
+  # Languages ASSIGN_LANGUAGES gives an expansion, for loads that don't go through the database
+  if expansion in overrides:
+    return overrides[expansion]
+  return jap_languages if is_jap else world_languages
+
+# Expansions that have no language yet get the default languages of their table, or their
+# override if they have one. Overrides only apply to the expansions of the tables being assigned
+ASSIGN_LANGUAGES = """
+    WITH overrides (expansion, language) AS (
+        SELECT * FROM unnest(%(override_expansions)s::text[], %(override_languages)s::text[])
+    ), defaults (expansion, language) AS (
+        SELECT world.id, languages.language
+        FROM CardExpansionWorld AS world CROSS JOIN unnest(%(world_languages)s::text[]) AS languages (language)
+        UNION ALL
+        SELECT jap.id, languages.language
+        FROM CardExpansionJap AS jap CROSS JOIN unnest(%(jap_languages)s::text[]) AS languages (language)
+    ), assigned (expansion, language) AS (
+        SELECT expansion, language FROM defaults WHERE expansion NOT IN (SELECT expansion FROM overrides)
+        UNION ALL
+        SELECT expansion, language FROM overrides WHERE expansion IN (SELECT expansion FROM defaults)
+    )
+    INSERT INTO allowedexpansionlanguage (expansion, language)
+    SELECT expansion, language FROM assigned
+    WHERE NOT EXISTS (
+        SELECT 1 FROM allowedexpansionlanguage WHERE allowedexpansionlanguage.expansion = assigned.expansion
+    )
+    ON CONFLICT DO NOTHING
+"""
+
+@timed('assign_expansion_languages')
+def assign_expansion_languages(db, world_languages=EU_LANGUAGES, jap_languages=JAP_LANGUAGES, overrides=LANGUAGE_OVERRIDES):
+  # Assigns the languages of the whole catalogue server side with one statement, returns the rows inserted
+  pairs = [(expansion, language) for expansion, languages in overrides.items() for language in languages]
+  with db.connection() as conn:
+    cursor = conn.cursor()
+    cursor.execute(ASSIGN_LANGUAGES, {
+      'world_languages': list(world_languages),
+      'jap_languages': list(jap_languages),
+      'override_expansions': [expansion for expansion, language in pairs],
+      'override_languages': [language for expansion, language in pairs],
+    })
+    inserted = cursor.rowcount
+    commit(conn)
+    cursor.close()
+  logger.info('Assigned expansion languages', extra={'rows': inserted})
+  return inserted
+
+def insert_eu_languages(db, overrides=LANGUAGE_OVERRIDES):
+    return assign_expansion_languages(db, jap_languages=[], overrides=overrides)
+
+def insert_jp_language(db, overrides=LANGUAGE_OVERRIDES):
+   return assign_expansion_languages(db, world_languages=[], overrides=overrides)
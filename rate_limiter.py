@@ -0,0 +1,57 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+DEFAULT_REQUESTS_PER_SECOND = 2
+DEFAULT_BURST = 4
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate # tokens refilled per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Block until a token is available, then consume it
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+class HostRateLimiter:
+    def __init__(self, requests_per_second=DEFAULT_REQUESTS_PER_SECOND, burst=DEFAULT_BURST):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def configure(self, requests_per_second=None, burst=None):
+        with self.lock:
+            if requests_per_second is not None:
+                self.requests_per_second = requests_per_second
+            if burst is not None:
+                self.burst = burst
+            self.buckets = {} # buckets are rebuilt lazily with the new settings
+
+    def acquire(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.requests_per_second, self.burst)
+                self.buckets[host] = bucket
+        bucket.acquire()
+
+# Shared by every fetch of the process, so concurrent workers hitting the same host share its budget
+RATE_LIMITER = HostRateLimiter()
+
+def configure_rate_limit(requests_per_second=None, burst=None):
+    RATE_LIMITER.configure(requests_per_second, burst)
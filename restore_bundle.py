@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+from contextlib import ExitStack
+from datetime import date
+
+from psycopg2.extras import Json
+
+from csv_rows import read_card_rows, is_missing
+from lookup_cache import LOOKUP_TABLES
+from metrics import timed
+from populate_db import (collect_set_files, create_sets_dictionary, get_super_expansion, expansion_values, card_values, card_tuples,
+                         expansion_languages, IMAGES_PATH)
+
+# Offline bulk-restore bundle: the scraped CSVs turned into one tab-separated COPY file per table and
+# a script loading them in dependency order, in a single transaction:
+#   cd <bundle> && psql -d <replica> -f restore.sql
+# Building it needs no database. Expansions, cards and languages are copied as they are, so the
+# replica must not have them yet. Lookup values (rarities, versions, illustrators) go through a
+# staging table, and only the values the replica is missing are added
+RESTORE_SCRIPT = 'restore.sql'
+LOOKUP_FILES = {kind: f'{kind}.tsv' for kind in LOOKUP_TABLES}
+# file -> (table, columns), in the order restore.sql loads them
+COPY_FILES = {
+    'card_expansion.tsv': ('CardExpansion', ('id', 'name', 'release_date', 'main_set_number', 'generation', 'super_expansion', 'icon_path', 'symbol_path')),
+    'card_expansion_world.tsv': ('CardExpansionWorld', ('id', 'italian_name')),
+    'card_expansion_jap.tsv': ('CardExpansionJap', ('id',)),
+    'card_type.tsv': ('CardType', ('number', 'expansion', 'illustrator', 'name', 'rarity', 'image_path', 'image_paths')),
+    'version_card_type.tsv': ('versionCardType', ('version', 'card_number', 'card_expansion')),
+    'allowed_expansion_language.tsv': ('allowedexpansionlanguage', ('expansion', 'language')),
+}
+
+logger = logging.getLogger(__name__)
+
+def copy_field(value):
+    # COPY text format: \N is NULL, backslashes, tabs and line breaks are escaped
+    if value is None or is_missing(value):
+        return '\\N'
+    if isinstance(value, Json):
+        value = json.dumps(value.adapted, ensure_ascii=False)
+    elif isinstance(value, date): # datetimes too, the release dates are days
+        value = value.strftime('%Y-%m-%d')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+class BundleWriter:
+    def __init__(self, bundle_path):
+        self.bundle_path = bundle_path
+        self.stack = ExitStack()
+        self.files = {}
+        self.rows = {filename: 0 for filename in [*LOOKUP_FILES.values(), *COPY_FILES]}
+        self.lookups = {kind: {} for kind in LOOKUP_TABLES}
+
+    def write(self, filename, row):
+        file = self.files.get(filename)
+        if file is None:
+            file = self.files[filename] = self.stack.enter_context(open(os.path.join(self.bundle_path, filename), 'w', encoding='utf-8', newline=''))
+        file.write('\t'.join(copy_field(value) for value in row) + '\n')
+        self.rows[filename] += 1
+
+    def add_lookups(self, kind, values):
+        # Written once every set is read, each value once
+        self.lookups[kind].update(dict.fromkeys(values))
+
+    def close(self):
+        for kind, values in self.lookups.items():
+            for value in values:
+                self.write(LOOKUP_FILES[kind], (value,))
+        # Empty tables still get their (empty) file, so restore.sql never misses one
+        for filename in self.rows:
+            if filename not in self.files:
+                open(os.path.join(self.bundle_path, filename), 'w').close()
+        self.stack.close()
+        write_restore_script(self.bundle_path, self.rows)
+
+    def abort(self):
+        # A partial bundle has no restore.sql, so it can't be loaded by mistake
+        self.stack.close()
+        script_path = os.path.join(self.bundle_path, RESTORE_SCRIPT)
+        if os.path.exists(script_path):
+            os.remove(script_path)
+
+def write_restore_script(bundle_path, rows):
+    lines = [
+        f"-- Bulk restore of {rows['card_expansion.tsv']} expansions and {rows['card_type.tsv']} cards, run from this folder:",
+        f'--   psql -d <replica> -f {RESTORE_SCRIPT}',
+        '\\set ON_ERROR_STOP on',
+        "SET client_encoding = 'UTF8';",
+        'BEGIN;',
+        'CREATE TEMP TABLE bundle_lookup (value text) ON COMMIT DROP;',
+    ]
+    for kind, filename in LOOKUP_FILES.items():
+        table, column = LOOKUP_TABLES[kind]
+        lines += [
+            f"\\copy bundle_lookup (value) FROM '{filename}'",
+            f'INSERT INTO {table} ({column}) SELECT value FROM bundle_lookup WHERE value IS NOT NULL '
+            f'AND NOT EXISTS (SELECT 1 FROM {table} WHERE {table}.{column} = bundle_lookup.value);',
+            'TRUNCATE bundle_lookup;',
+        ]
+    for filename, (table, columns) in COPY_FILES.items():
+        lines.append(f"\\copy {table} ({', '.join(columns)}) FROM '{filename}'")
+    lines.append('COMMIT;')
+    with open(os.path.join(bundle_path, RESTORE_SCRIPT), 'w', encoding='utf-8', newline='\n') as file:
+        file.write('\n'.join(lines) + '\n')
+
+@timed('build_restore_bundle')
+def build_restore_bundle(bundle_path, sources, all_sets_path=None, images_path=IMAGES_PATH):
+    # sources are (sets_path, cards_path, is_jap) tuples, e.g. the sets/ and cards/ folders of a scrape.
+    # The rows are the ones populate_expansion_table(bulk=True) and assign_expansion_languages would
+    # insert, but only images already on disk (under images_path) get a path. The CSVs are left where they are
+    sets_dict = create_sets_dictionary(all_sets_path) if all_sets_path else None
+    os.makedirs(bundle_path, exist_ok=True)
+    writer = BundleWriter(bundle_path)
+    expansions = set()
+    try:
+        for sets_path, cards_path, is_jap in sources:
+            for file_detail in collect_set_files(sets_path):
+                filename = file_detail['filename']
+                set_path = os.path.join(sets_path, filename)
+                set_cards_path = os.path.join(cards_path, filename.split('.')[0]+'_cards.csv')
+                super_expansion = get_super_expansion(filename)
+                for row in file_detail['rows']:
+                    values = expansion_values(row, is_jap, sets_dict, super_expansion, set_path, offline=True, images_path=images_path)
+                    if values is None:
+                        continue
+                    expansion, localized_expansion, _ = values
+                    expansion_id = expansion[0]
+                    if expansion_id in expansions:
+                        logger.warning('Expansion already in the bundle', extra={'expansion': expansion_id, 'source': set_path})
+                        continue
+                    expansions.add(expansion_id)
+                    writer.write('card_expansion.tsv', expansion)
+                    writer.write('card_expansion_jap.tsv' if is_jap else 'card_expansion_world.tsv', localized_expansion)
+                    for language in expansion_languages(expansion_id, is_jap):
+                        writer.write('allowed_expansion_language.tsv', (expansion_id, language))
+
+                    card_rows, version_rows, rarities, versions, illustrators = card_values(expansion_id, card_tuples(read_card_rows(set_cards_path)), images_path)
+                    for card_row in card_rows:
+                        writer.write('card_type.tsv', card_row)
+                    for version_row in version_rows:
+                        writer.write('version_card_type.tsv', version_row)
+                    writer.add_lookups('rarity', rarities)
+                    writer.add_lookups('version', versions)
+                    writer.add_lookups('illustrator', illustrators)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    logger.info('Restore bundle written', extra={'path': bundle_path, 'expansions': writer.rows['card_expansion.tsv'], 'cards': writer.rows['card_type.tsv']})
+    return writer.rows
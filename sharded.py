@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from pokellector_scraper import scrape_set, scrape_card_info, write_set_csv, CardsCsvWriter, export_columnar, index_cards
+from checkpoint import CrawlJournal
+from work_queue import WorkQueue
+from metrics import METRICS
+
+# Layout of a sharded crawl in save_path:
+#   shards/queue.sqlite                        lease queue of sets and cards shared by every worker
+#   shards/<worker>/sets/<set_id>.json         set info and card urls, written by the worker that scraped the set
+#   shards/<worker>/cards/<set_id>.jsonl       cards scraped by the worker, one CrawlJournal per set
+# merge_shards() turns them into the usual sets/ and cards/ CSVs for populate_expansion_table
+SHARDS_DIR = 'shards'
+QUEUE_FILE = 'queue.sqlite'
+LEASE = 600 # seconds before the item of a silent worker can be claimed by another one
+IDLE_WAIT = 2 # seconds a worker waits when the remaining items are leased by other workers
+
+logger = logging.getLogger(__name__)
+
+def shards_path(save_path):
+    return os.path.join(save_path, SHARDS_DIR)
+
+def open_queue(save_path, owner=None):
+    return WorkQueue(os.path.join(shards_path(save_path), QUEUE_FILE), lease=LEASE, owner=owner)
+
+def default_worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+def write_json(path, data):
+    # Written to a temporary file first, so a worker dying halfway never leaves half a file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+class ShardWorker:
+    # One process of a sharded crawl: claims sets and cards from the shared queue on `threads` threads
+    # and writes what it scrapes to its own shard directory, so workers never write the same file
+    def __init__(self, save_path, worker_id=None, threads=8):
+        self.worker_id = worker_id or default_worker_id()
+        self.shard_path = os.path.join(shards_path(save_path), self.worker_id)
+        self.queue = open_queue(save_path, self.worker_id)
+        self.threads = threads
+        self.journals = {}
+        self.lock = threading.Lock()
+
+    def run(self):
+        workers = [threading.Thread(target=self.work, daemon=True) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(IDLE_WAIT)
+        self.queue.close()
+        logger.info('Shard worker finished', extra={'worker': self.worker_id})
+
+    def work(self):
+        while True:
+            item = self.queue.claim()
+            if item is None:
+                if self.queue.active() == 0:
+                    return
+                time.sleep(IDLE_WAIT) # leased by other workers, they may die or add cards
+                continue
+            key, payload = item
+            try:
+                if payload.get('kind', 'set') == 'set':
+                    self.scrape_set(payload)
+                else:
+                    self.scrape_card(payload)
+            except Exception as e:
+                retry = self.queue.fail(key, e)
+                METRICS.count('shard_items_failed')
+                logger.exception('Shard item failed', extra={'url': key, 'retry': retry})
+            else:
+                self.queue.complete(key)
+
+    def scrape_set(self, payload):
+        scraped = scrape_set(payload['url'])
+        if not scraped:
+            raise RuntimeError(f"Failed to retrieve {payload['url']}")
+        set_id, set_name, number_of_cards, number_of_secret_cards, formatted_release_date, card_urls, icon_image, symbol_image = scraped
+        set_info = [set_id, set_name, number_of_cards, number_of_secret_cards, formatted_release_date, icon_image, symbol_image,
+                    payload.get('generation'), payload.get('italian_name', '')]
+        write_json(os.path.join(self.shard_path, 'sets', f'{set_id}.json'),
+                   {'info': set_info, 'is_jap': payload['is_jap'], 'card_urls': card_urls})
+        for card_url in card_urls:
+            self.queue.add(card_url, {'kind': 'card', 'url': card_url, 'set_id': set_id})
+
+    def scrape_card(self, payload):
+        card_info = scrape_card_info(payload['url'], payload['set_id'])
+        if not card_info:
+            raise RuntimeError(f"Failed to retrieve {payload['url']}")
+        self.journal(payload['set_id']).record(payload['url'], card_info)
+
+    def journal(self, set_id):
+        with self.lock:
+            journal = self.journals.get(set_id)
+            if journal is None:
+                journal = self.journals[set_id] = CrawlJournal(os.path.join(self.shard_path, 'cards', f'{set_id}.jsonl'))
+            return journal
+
+def seed_queue(save_path, set_payloads):
+    # set_payloads are dicts with url, generation, is_jap and optionally italian_name. Sets are queued
+    # before their cards, so they are claimed first and every worker soon has cards to scrape
+    with open_queue(save_path) as queue:
+        for payload in set_payloads:
+            queue.add(payload['url'], {'kind': 'set', **payload})
+
+def read_shards(save_path):
+    # set_id -> set record and set_id -> {card url: card}, merged across every shard
+    sets = {}
+    cards = {}
+    root = shards_path(save_path)
+    for worker_id in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        sets_dir = os.path.join(root, worker_id, 'sets')
+        cards_dir = os.path.join(root, worker_id, 'cards')
+        for filename in sorted(os.listdir(sets_dir)) if os.path.isdir(sets_dir) else []:
+            if filename.endswith('.json'):
+                with open(os.path.join(sets_dir, filename), 'r', encoding='utf-8') as file:
+                    sets[filename[:-len('.json')]] = json.load(file)
+        for filename in sorted(os.listdir(cards_dir)) if os.path.isdir(cards_dir) else []:
+            if filename.endswith('.jsonl'):
+                # A card scraped twice (its lease expired) is the same card, either copy will do
+                cards.setdefault(filename[:-len('.jsonl')], {}).update(CrawlJournal(os.path.join(cards_dir, filename)).done)
+    return sets, cards
+
+def merge_shards(save_path, partial=False):
+    # Writes sets/ and cards/ CSVs for every set whose cards have all been scraped (or every set with
+    # partial=True), with the cards in the order of the set page. Returns the ids of the merged sets
+    sets, cards = read_shards(save_path)
+    os.makedirs(os.path.join(save_path, 'sets'), exist_ok=True)
+    os.makedirs(os.path.join(save_path, 'cards'), exist_ok=True)
+    merged = []
+    for set_id, set_record in sorted(sets.items()):
+        set_cards = cards.get(set_id, {})
+        missing = [card_url for card_url in set_record['card_urls'] if card_url not in set_cards]
+        if missing and not partial:
+            logger.warning('Set not merged, cards missing', extra={'set_id': set_id, 'missing': len(missing)})
+            continue
+        ordered_cards = [set_cards[card_url] for card_url in set_record['card_urls'] if card_url in set_cards]
+        write_set_csv(save_path, set_id, set_record['info'], set_record['is_jap'])
+        with CardsCsvWriter(save_path, set_id) as writer:
+            for card in ordered_cards:
+                writer.write(card)
+        export_columnar(set_record['info'], ordered_cards, set_record['is_jap'])
+        index_cards(set_record['info'], ordered_cards, set_record['is_jap'])
+        merged.append(set_id)
+    logger.info('Shards merged', extra={'sets': len(merged), 'skipped': len(sets) - len(merged)})
+    return merged
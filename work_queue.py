@@ -0,0 +1,130 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+MAX_ATTEMPTS = 3 # an item failing this many times is left as failed
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+class WorkQueue:
+    # Crawl items kept in a SQLite file, so a crawl stopped halfway restarts from the items it had not
+    # finished. Items are claimed by priority then insertion order, and a failed item is put back with
+    # a higher priority so it is retried before the items that were never tried.
+    # With a lease (seconds) several processes can share the file: a claimed item is owned until its
+    # lease runs out, then any worker can claim it again, so the items of a dead worker are not lost
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS, lease=None, owner=None):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.owner = owner
+        self.lock = threading.Lock()
+        # Autocommit, claims open their own transaction
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS items (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT UNIQUE NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                priority INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated REAL,
+                owner TEXT,
+                lease_until REAL
+            )
+        ''')
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(items)')}
+        for column, column_type in (('owner', 'TEXT'), ('lease_until', 'REAL')): # queues created before leases
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE items ADD COLUMN {column} {column_type}')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS items_claim ON items (status, priority DESC, seq)')
+
+    def recover(self):
+        # Items left running by a process that died are claimed again
+        with self.lock:
+            self.conn.execute('UPDATE items SET status = ? WHERE status = ?', (PENDING, RUNNING))
+
+    def add(self, key, payload, priority=0):
+        # Items already in the queue, whatever their status, are not added again
+        with self.lock:
+            cursor = self.conn.execute(
+                'INSERT OR IGNORE INTO items (key, payload, priority, updated) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(payload), priority, time.time())
+            )
+        return cursor.rowcount == 1
+
+    def claim(self):
+        # (key, payload) of the next item, None if nothing is pending or has an expired lease
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE') # other processes wait here, so an item is claimed once
+            try:
+                now = time.time()
+                row = self.conn.execute(
+                    'SELECT key, payload FROM items WHERE status = ? OR (status = ? AND lease_until < ?) ORDER BY priority DESC, seq LIMIT 1',
+                    (PENDING, RUNNING, now)
+                ).fetchone()
+                if row is not None:
+                    lease_until = now + self.lease if self.lease else None
+                    self.conn.execute(
+                        'UPDATE items SET status = ?, owner = ?, lease_until = ?, updated = ? WHERE key = ?',
+                        (RUNNING, self.owner, lease_until, now, row[0])
+                    )
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def complete(self, key):
+        with self.lock:
+            self.conn.execute('UPDATE items SET status = ?, error = NULL, updated = ? WHERE key = ?', (DONE, time.time(), key))
+
+    def fail(self, key, error):
+        # Returns True if the item will be retried
+        with self.lock:
+            attempts = self.conn.execute('SELECT attempts FROM items WHERE key = ?', (key,)).fetchone()[0] + 1
+            retry = attempts < self.max_attempts
+            self.conn.execute(
+                'UPDATE items SET status = ?, attempts = ?, priority = priority + 1, error = ?, updated = ? WHERE key = ?',
+                (PENDING if retry else FAILED, attempts, str(error), time.time(), key)
+            )
+        return retry
+
+    def active(self):
+        # Items pending or running, running ones may still fail or see their lease expire
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM items WHERE status IN (?, ?)', (PENDING, RUNNING)).fetchone()[0]
+
+    def retry_failed(self):
+        # Gives the items that used up their attempts another round
+        with self.lock:
+            self.conn.execute('UPDATE items SET status = ?, attempts = 0 WHERE status = ?', (PENDING, FAILED))
+
+    def keys(self, status):
+        # Keys with the given status, in the order they would be claimed
+        with self.lock:
+            rows = self.conn.execute('SELECT key FROM items WHERE status = ? ORDER BY priority DESC, seq', (status,)).fetchall()
+        return [row[0] for row in rows]
+
+    def counts(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT status, COUNT(*) FROM items GROUP BY status').fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()